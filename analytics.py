@@ -0,0 +1,222 @@
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from db import get_or_create_db
+from export import SCHEMAS, read_table, open_export
+
+POST_COLUMNS = ["id", "author", "likes_count", "plays_count", "reposts_count", "shares_count", "created"]
+COMMENT_COLUMNS = ["id", "post", "author", "created", "likes_count", "liked_by_author", "parent"]
+USER_COLUMNS = ["id", "username"]
+
+# running per-post and per-commenter totals, kept current by statement-level triggers that aggregate
+# each INSERT/UPDATE's transition table, so a flush of thousands of comments costs one grouped upsert
+AGGREGATES = [
+    """
+        CREATE TABLE IF NOT EXISTS post_stats (
+            post TEXT NOT NULL PRIMARY KEY,
+            comments_count BIGINT NOT NULL DEFAULT 0,
+            replies_count BIGINT NOT NULL DEFAULT 0,
+            liked_by_author_count BIGINT NOT NULL DEFAULT 0,
+            comment_likes BIGINT NOT NULL DEFAULT 0
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS commenter_stats (
+            author TEXT NOT NULL PRIMARY KEY,
+            comments_count BIGINT NOT NULL DEFAULT 0,
+            comment_likes BIGINT NOT NULL DEFAULT 0
+        )
+    """,
+    """
+        CREATE OR REPLACE FUNCTION apply_comment_stats() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            CREATE TEMP TABLE IF NOT EXISTS comment_stats_delta (post TEXT, author TEXT, comments INT, replies INT, liked INT, likes BIGINT) ON COMMIT DROP;
+            INSERT INTO comment_stats_delta
+                SELECT post, author, 1, (parent IS NOT NULL)::int, (liked_by_author IS TRUE)::int, coalesce(likes_count, 0)
+                FROM new_rows WHERE deleted IS NOT TRUE;
+            IF TG_OP = 'UPDATE' THEN
+                INSERT INTO comment_stats_delta
+                    SELECT post, author, -1, -(parent IS NOT NULL)::int, -(liked_by_author IS TRUE)::int, -coalesce(likes_count, 0)
+                    FROM old_rows WHERE deleted IS NOT TRUE;
+            END IF;
+            INSERT INTO post_stats AS s (post, comments_count, replies_count, liked_by_author_count, comment_likes)
+                SELECT post, sum(comments), sum(replies), sum(liked), sum(likes) FROM comment_stats_delta GROUP BY post
+                ON CONFLICT (post) DO UPDATE SET
+                    comments_count = s.comments_count + EXCLUDED.comments_count,
+                    replies_count = s.replies_count + EXCLUDED.replies_count,
+                    liked_by_author_count = s.liked_by_author_count + EXCLUDED.liked_by_author_count,
+                    comment_likes = s.comment_likes + EXCLUDED.comment_likes;
+            INSERT INTO commenter_stats AS s (author, comments_count, comment_likes)
+                SELECT author, sum(comments), sum(likes) FROM comment_stats_delta GROUP BY author
+                ON CONFLICT (author) DO UPDATE SET
+                    comments_count = s.comments_count + EXCLUDED.comments_count,
+                    comment_likes = s.comment_likes + EXCLUDED.comment_likes;
+            DELETE FROM comment_stats_delta;
+            RETURN NULL;
+        END
+        $$
+    """,
+    # transition tables allow one event per trigger, so inserts and updates get a trigger each
+    "DROP TRIGGER IF EXISTS comment_stats_insert ON comments",
+    "CREATE TRIGGER comment_stats_insert AFTER INSERT ON comments REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION apply_comment_stats()",
+    "DROP TRIGGER IF EXISTS comment_stats_update ON comments",
+    "CREATE TRIGGER comment_stats_update AFTER UPDATE ON comments REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION apply_comment_stats()",
+]
+
+REBUILD_AGGREGATES = [
+    "LOCK TABLE comments IN SHARE MODE",
+    "TRUNCATE post_stats, commenter_stats",
+    """
+        INSERT INTO post_stats (post, comments_count, replies_count, liked_by_author_count, comment_likes)
+        SELECT post, count(*), count(parent), count(*) FILTER (WHERE liked_by_author), coalesce(sum(likes_count), 0)
+        FROM comments WHERE deleted IS NOT TRUE GROUP BY post
+    """,
+    """
+        INSERT INTO commenter_stats (author, comments_count, comment_likes)
+        SELECT author, count(*), coalesce(sum(likes_count), 0)
+        FROM comments WHERE deleted IS NOT TRUE GROUP BY author
+    """,
+]
+
+def create_aggregates(conn, rebuild=False):
+    # the triggers only see rows written after they exist, rebuild backfills the totals from the comments table
+    with conn.cursor() as cur:
+        for query in AGGREGATES:
+            cur.execute(query)
+        if rebuild:
+            for query in REBUILD_AGGREGATES:
+                cur.execute(query)
+    conn.commit()
+
+def numbers(table, name, fill=0):
+    return pc.fill_null(table[name], fill).to_numpy()
+
+def seconds(table, name):
+    # timestamps as float epoch seconds, NaN where missing
+    values = pc.cast(table[name], pa.int64()).to_numpy(zero_copy_only=False)
+    return np.asarray(values, dtype=np.float64) / 1e6
+
+def positions(values, value_set):
+    # index of each value in value_set, -1 where it is missing or null
+    return pc.fill_null(pc.index_in(values, value_set=value_set), -1).to_numpy()
+
+def select(schema, names):
+    return pa.schema([schema.field(name) for name in names])
+
+class Engagement:
+    # column arrays for posts and comments, every statistic is a handful of whole-array numpy operations
+    def __init__(self, posts, comments, users=None):
+        self.posts = posts.combine_chunks()
+        self.comments = comments.combine_chunks()
+        self.users = users.combine_chunks() if users is not None else None
+        self.post_ids = self.posts["id"].combine_chunks()
+        self.comment_post = positions(self.comments["post"], self.post_ids)
+        self.comment_parent = positions(self.comments["parent"], self.comments["id"].combine_chunks())
+
+    @classmethod
+    def from_db(cls, conn):
+        posts = read_table(conn, f"SELECT {', '.join(POST_COLUMNS)} FROM posts WHERE deleted IS NOT TRUE", (), select(SCHEMAS["posts"], POST_COLUMNS))
+        comments = read_table(conn, f"SELECT {', '.join(COMMENT_COLUMNS)} FROM comments WHERE deleted IS NOT TRUE", (), select(SCHEMAS["comments"], COMMENT_COLUMNS))
+        users = read_table(conn, f"SELECT {', '.join(USER_COLUMNS)} FROM users", (), select(SCHEMAS["users"], USER_COLUMNS))
+        conn.commit()
+        return cls(posts, comments, users)
+
+    @classmethod
+    def from_export(cls, path):
+        # incremental exports append refreshed rows, so only the most recently scraped version of each id is kept
+        def latest(table, columns):
+            data = open_export(path, table).to_table(columns=columns + [name for name in ("scraped", "deleted") if name in SCHEMAS[table].names])
+            if data.num_rows:
+                data = data.sort_by([("scraped", "descending")])
+                codes = pc.dictionary_encode(data["id"]).combine_chunks().indices.to_numpy()
+                data = data.take(np.sort(np.unique(codes, return_index=True)[1]))
+                if "deleted" in data.column_names:
+                    data = data.filter(pc.invert(pc.fill_null(data["deleted"], False)))
+            return data.select(columns)
+        return cls(latest("posts", POST_COLUMNS), latest("comments", COMMENT_COLUMNS), latest("users", USER_COLUMNS))
+
+    def comment_counts(self):
+        known = self.comment_post >= 0
+        return np.bincount(self.comment_post[known], minlength=self.posts.num_rows)
+
+    def post_engagement(self):
+        likes = numbers(self.posts, "likes_count")
+        shares = numbers(self.posts, "shares_count")
+        reposts = numbers(self.posts, "reposts_count")
+        plays = numbers(self.posts, "plays_count").astype(np.float64)
+        comments = self.comment_counts()
+        interactions = likes + shares + reposts + comments
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rate = np.where(plays > 0, interactions / plays, np.nan)
+        return pa.table({"post": self.post_ids, "plays": plays, "likes": likes, "shares": shares, "reposts": reposts, "comments": comments, "engagement_rate": rate})
+
+    def comment_velocity(self, bin_seconds=3600, horizon=7 * 86400):
+        # comments per bin of time since the post was created, over every post; ages past horizon are dropped
+        known = self.comment_post >= 0
+        age = seconds(self.comments, "created")[known] - seconds(self.posts, "created")[self.comment_post[known]]
+        age = age[np.isfinite(age) & (age >= 0) & (age < horizon)]
+        edges = np.arange(0, horizon + bin_seconds, bin_seconds, dtype=np.float64)
+        counts, _ = np.histogram(age, bins=edges)
+        return pa.table({"since_created": edges[:-1], "comments": counts, "comments_per_hour": counts * (3600 / bin_seconds)})
+
+    def reply_depths(self):
+        # depth by pointer jumping: each pass adds the depth of the current ancestor and jumps to that ancestor's
+        # ancestor, so a chain of length d resolves in log2(d) passes rather than d
+        parent = self.comment_parent
+        # a reply whose parent was never stored hangs directly under the top-level comment, as threaded_comments_and_replies puts it
+        orphan = (parent < 0) & pc.is_valid(self.comments["parent"]).to_numpy(zero_copy_only=False)
+        depth = ((parent >= 0) | orphan).astype(np.int64)
+        ancestor = parent.copy()
+        for _ in range(int(np.log2(len(parent) + 1)) + 1):
+            active = ancestor >= 0
+            if not active.any():
+                break
+            target = np.where(active, ancestor, 0)
+            depth = np.where(active, depth + depth[target], depth)
+            ancestor = np.where(active, ancestor[target], -1)
+        # whatever never reached a top-level comment sits on a parent cycle, threaded_comments_and_replies
+        # attaches those replies directly under the comment
+        depth[ancestor >= 0] = 1
+        return depth
+
+    def reply_depth_distribution(self):
+        counts = np.bincount(self.reply_depths())
+        return pa.table({"depth": np.arange(len(counts)), "comments": counts})
+
+    def top_commenters(self, limit=100):
+        encoded = pc.dictionary_encode(self.comments["author"]).combine_chunks()
+        codes = encoded.indices.to_numpy(zero_copy_only=False)
+        comments = np.bincount(codes, minlength=len(encoded.dictionary))
+        likes = np.bincount(codes, weights=numbers(self.comments, "likes_count"), minlength=len(encoded.dictionary))
+        top = np.argsort(-comments, kind="stable")[:limit]
+        authors = encoded.dictionary.take(pa.array(top, pa.int64()))
+        result = {"author": authors, "comments": comments[top], "comment_likes": likes[top].astype(np.int64)}
+        if self.users is not None:
+            found = positions(authors, self.users["id"].combine_chunks())
+            result["username"] = self.users["username"].combine_chunks().take(pa.array(found, mask=found < 0))
+        return pa.table(result)
+
+    def liked_by_author_ratio(self):
+        known = self.comment_post >= 0
+        liked = numbers(self.comments, "liked_by_author", False)[known]
+        comments = self.comment_counts()
+        liked_counts = np.bincount(self.comment_post[known], weights=liked, minlength=self.posts.num_rows).astype(np.int64)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratio = np.where(comments > 0, liked_counts / comments, np.nan)
+        return pa.table({"post": self.post_ids, "comments": comments, "liked_by_author": liked_counts, "ratio": ratio})
+
+def main():
+    conn = get_or_create_db()
+    try:
+        create_aggregates(conn, rebuild=True)
+        engagement = Engagement.from_db(conn)
+    finally:
+        conn.close()
+    posts = engagement.post_engagement().sort_by([("engagement_rate", "descending")])
+    for post in posts.slice(0, 10).to_pylist():
+        print(post["post"], f"{post['engagement_rate']:.4f}", post["comments"])
+    for row in engagement.reply_depth_distribution().to_pylist():
+        print("depth", row["depth"], row["comments"])
+
+if __name__ == "__main__":
+    main()
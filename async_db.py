@@ -0,0 +1,96 @@
+from psycopg_pool import AsyncConnectionPool
+from metrics import metrics
+from db import DB_CONN, SCHEMA, STAGING_TABLES, MERGE_QUERIES, WriteBuffer, user_rows, post_row, comment_rows
+
+async def create_schema(conn):
+    async with conn.cursor() as cur:
+        for query in SCHEMA:
+            await cur.execute(query)
+
+async def open_pool(min_size=1, max_size=4, conninfo=DB_CONN):
+    # the schema is created once here, pooled connections are handed out without any setup
+    pool = AsyncConnectionPool(conninfo, min_size=min_size, max_size=max_size, open=False)
+    await pool.open()
+    async with pool.connection() as conn:
+        await create_schema(conn)
+    return pool
+
+async def get_all_items_in_db(pool):
+    async with pool.connection() as conn:
+        cur = await conn.execute("SELECT id FROM posts")
+        return [row[0] for row in await cur.fetchall()]
+
+async def insert_all_to_db(conn, users, post, comments):
+    users_query = "INSERT INTO users (id, username, nickname, bio, region, scraped) VALUES (%s, %s, %s, %s, %s, now()) ON CONFLICT (id) DO NOTHING"
+    post_query = "INSERT INTO posts (id, title, author, width, height, format, duration, likes_count, plays_count, reposts_count, shares_count, created, scraped) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, to_timestamp(%s), now()) ON CONFLICT (id) DO NOTHING"
+    comments_query = "INSERT INTO comments (id, post, author, created, likes_count, text, liked_by_author, parent, scraped) VALUES (%s, %s, %s, to_timestamp(%s), %s, %s, %s, %s, now()) ON CONFLICT (id) DO NOTHING"
+
+    async with conn.pipeline():
+        async with conn.cursor() as cur:
+            await cur.executemany(users_query, user_rows(users))
+            await cur.execute(post_query, post_row(post))
+            await cur.executemany(comments_query, comment_rows(post, comments))
+    return conn
+
+class AsyncBulkWriter(WriteBuffer):
+    def __init__(self, pool, flush_size=5000, flush_interval=5.0):
+        super().__init__(flush_size, flush_interval)
+        self.pool = pool
+
+    async def __copy(self, conn, batch):
+        async with conn.cursor() as cur:
+            for query in STAGING_TABLES:
+                await cur.execute(query)
+            async with cur.copy("COPY staging_users (id, username, nickname, bio, region) FROM STDIN") as copy:
+                for users, _, _ in batch:
+                    for row in user_rows(users):
+                        await copy.write_row(row)
+            async with cur.copy("COPY staging_posts (id, title, author, width, height, format, duration, likes_count, plays_count, reposts_count, shares_count, created) FROM STDIN") as copy:
+                for _, post, _ in batch:
+                    await copy.write_row(post_row(post))
+            async with cur.copy("COPY staging_comments (id, post, author, created, likes_count, text, liked_by_author, parent) FROM STDIN") as copy:
+                for _, post, comments in batch:
+                    for row in comment_rows(post, comments):
+                        await copy.write_row(row)
+            async with conn.pipeline():
+                for query in MERGE_QUERIES:
+                    await cur.execute(query)
+
+    @staticmethod
+    def __count(batch):
+        metrics.inc("db_rows_written_total", sum(len(users) for users, _, _ in batch), table="users")
+        metrics.inc("db_rows_written_total", len(batch), table="posts")
+        metrics.inc("db_rows_written_total", sum(len(comments) for _, _, comments in batch), table="comments")
+
+    async def __commit(self, conn):
+        with metrics.timer("db_commit_seconds"):
+            await conn.commit()
+
+    async def flush(self):
+        # returns (processed post ids, [(post id, error)]); a failed batch is retried post by post to isolate the bad one
+        batch = self.take()
+        if not batch:
+            return [], []
+        with metrics.timer("db_flush_seconds"):
+            return await self.__flush(batch)
+
+    async def __flush(self, batch):
+        async with self.pool.connection() as conn:
+            try:
+                await self.__copy(conn, batch)
+                await self.__commit(conn)
+                self.__count(batch)
+                return [post['id'] for _, post, _ in batch], []
+            except Exception:
+                await conn.rollback()
+            processed, failed = [], []
+            for users, post, comments in batch:
+                try:
+                    await insert_all_to_db(conn, users, post, comments)
+                    await self.__commit(conn)
+                    self.__count([(users, post, comments)])
+                    processed.append(post['id'])
+                except Exception as e:
+                    await conn.rollback()
+                    failed.append((post['id'], e))
+            return processed, failed
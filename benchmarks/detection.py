@@ -0,0 +1,41 @@
+import random
+import string
+import timeit
+from detection import detect_relevant_content, KeywordMatcher
+
+def generate_keywords(count, rng):
+    return ["".join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 9))) for _ in range(count)]
+
+def generate_texts(count, keywords, rng):
+    texts = []
+    for _ in range(count):
+        words = ["".join(rng.choices(string.ascii_letters, k=rng.randint(2, 10))) for _ in range(rng.randint(5, 40))]
+        if rng.random() < 0.2:
+            words.insert(rng.randrange(len(words) + 1), rng.choice(keywords))
+        texts.append(" ".join(words))
+    return texts
+
+def main(keyword_count=200, text_count=500, repeat=3):
+    rng = random.Random(0)
+    include_list = generate_keywords(keyword_count, rng)
+    deny_list = generate_keywords(keyword_count // 10, rng)
+    texts = generate_texts(text_count, include_list, rng)
+
+    matcher = KeywordMatcher(include_list, deny_list)
+    for text in texts:
+        assert matcher.match(text) == detect_relevant_content(text, include_list, deny_list)
+
+    baseline = min(timeit.repeat(lambda: [detect_relevant_content(text, include_list, deny_list) for text in texts], number=1, repeat=repeat))
+    compiled = min(timeit.repeat(lambda: [matcher.match(text) for text in texts], number=1, repeat=repeat))
+    fuzzy_matcher = KeywordMatcher(include_list, deny_list, fuzzy_threshold=0.8)
+    fuzzy = min(timeit.repeat(lambda: [fuzzy_matcher.match(text) for text in texts], number=1, repeat=repeat))
+    build = min(timeit.repeat(lambda: KeywordMatcher(include_list, deny_list), number=1, repeat=repeat))
+
+    print(f"keywords={keyword_count} texts={text_count}")
+    print(f"detect_relevant_content: {baseline / text_count * 1e6:.1f} us/text")
+    print(f"KeywordMatcher.match:    {compiled / text_count * 1e6:.1f} us/text ({baseline / compiled:.0f}x)")
+    print(f"KeywordMatcher fuzzy:    {fuzzy / text_count * 1e6:.1f} us/text ({baseline / fuzzy:.0f}x)")
+    print(f"KeywordMatcher build:    {build * 1e3:.2f} ms")
+
+if __name__ == "__main__":
+    main()
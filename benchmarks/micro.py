@@ -0,0 +1,75 @@
+import random
+import timeit
+from utils import topological_sort, format_comment, format_reply, flatten_comments_and_replies, threaded_comments_and_replies
+from normalize import CommentNormalizer
+from benchmarks.stubs import user
+
+def raw_comment(index):
+    return {
+        "cid": f"c{index}",
+        "user": user(index, "http://localhost"),
+        "create_time": 1700000000 + index,
+        "digg_count": index,
+        "reply_comment_total": 3,
+        "text": f"comment {index}",
+        "is_author_digged": False
+    }
+
+def raw_reply(comment_index, index):
+    return {
+        "cid": f"c{comment_index}-r{index}",
+        "user": user(index, "http://localhost"),
+        "create_time": 1700000100 + index,
+        "digg_count": index,
+        "text": f"reply {index}",
+        "is_author_digged": False,
+        "reply_id": f"c{comment_index}",
+        "reply_to_reply_id": f"c{comment_index}-r{index - 1}" if index else f"c{comment_index}",
+        "reply_to_userid": "u0"
+    }
+
+def timed(label, function, count, repeat=3):
+    best = min(timeit.repeat(function, number=1, repeat=repeat))
+    print(f"{label:<28} {best * 1e3:9.2f} ms  {best / count * 1e6:7.2f} us/item")
+
+def main(comments=20000, replies=3):
+    rng = random.Random(0)
+    raw_comments = [raw_comment(i) for i in range(comments)]
+    raw_replies = [raw_reply(i, j) for i in range(comments) for j in range(replies)]
+    total = comments + len(raw_replies)
+
+    timed("format_comment", lambda: [format_comment(comment) for comment in raw_comments], comments)
+    timed("format_reply", lambda: [format_reply(reply) for reply in raw_replies], len(raw_replies))
+
+    def nested():
+        formatted = [format_comment(comment) for comment in raw_comments]
+        for i, comment in enumerate(formatted):
+            comment["replies"] = [format_reply(reply) for reply in raw_replies[i * replies:(i + 1) * replies]]
+        return formatted
+
+    timed("format + flatten", lambda: flatten_comments_and_replies(nested()), total)
+    flat = flatten_comments_and_replies(nested())
+    rng.shuffle(flat)
+    timed("topological_sort", lambda: topological_sort(flat), total)
+    timed("format + flatten + sort", lambda: topological_sort(flatten_comments_and_replies(nested())), total)
+
+    def normalize():
+        normalizer = CommentNormalizer("post")
+        for comment in raw_comments:
+            normalizer.add_comment(comment)
+        for reply in raw_replies:
+            normalizer.add_reply(reply)
+        return normalizer
+
+    timed("CommentNormalizer", normalize, total)
+
+    def chain(length=100000):
+        # one comment with a single deep reply chain, the worst case for the old quadratic threading
+        formatted = format_comment(raw_comments[0])
+        formatted["replies"] = [format_reply(raw_reply(0, j)) for j in range(length)]
+        return [formatted]
+
+    timed("threaded (deep chain)", lambda: threaded_comments_and_replies(chain()), 100000)
+
+if __name__ == "__main__":
+    main()
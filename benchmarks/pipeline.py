@@ -0,0 +1,118 @@
+# usage: python -m benchmarks.pipeline --posts 100 --comments 500 --latency 0.05 --throttle-rate 0.01 --s3
+import time
+import asyncio
+import argparse
+import resource
+import aiohttp
+import aioboto3
+import main
+from tiktok import TikTok
+from ratelimit import RateLimiter
+from async_db import open_pool, AsyncBulkWriter
+from media_cache import MediaCache
+from benchmarks.stubs import FakeTikTok, start_s3, start_postgres
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+class StageTimer:
+    def __init__(self):
+        self.samples = {}
+
+    def record(self, stage, started):
+        self.samples.setdefault(stage, []).append(time.perf_counter() - started)
+
+    def wrap(self, stage, function):
+        if asyncio.iscoroutinefunction(function):
+            async def timed(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    self.record(stage, started)
+        else:
+            def timed(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.record(stage, started)
+        return timed
+
+    def report(self):
+        for stage, samples in self.samples.items():
+            print(f"  {stage:<10} n={len(samples):<6} p50={percentile(samples, 0.5) * 1e3:8.2f}ms p99={percentile(samples, 0.99) * 1e3:8.2f}ms")
+
+async def run(args):
+    pg_server, conn_str = start_postgres()
+    s3_server, s3_endpoint = start_s3() if args.s3 else (None, None)
+    fake = FakeTikTok(args.comments, args.replies, args.reply_depth, latency=args.latency, throttle_rate=args.throttle_rate)
+    base_url = await fake.start()
+    timer = StageTimer()
+
+    class BenchTikTok(TikTok):
+        TIKTOK_BASE_URL = base_url
+        TEMP_VIDEO_BASE_URL = base_url
+
+    # the stages main() runs are wrapped in place so the pipeline itself is measured unchanged
+    BenchTikTok.get_normalized_comments = timer.wrap("fetch", TikTok.get_normalized_comments)
+    main.AsyncBulkWriter = type("TimedBulkWriter", (AsyncBulkWriter,), {"flush": timer.wrap("db_flush", AsyncBulkWriter.flush)})
+    limiter = RateLimiter(backoff_base=0.01, host_limits={"localhost": (args.rate, args.rate, args.host_concurrency)})
+    run_id = int(time.time())
+    posts = [dict(fake.post(i), id=f"bench{run_id}-{i}") for i in range(args.posts)]
+
+    try:
+        async with aiohttp.ClientSession() as session, await open_pool(conninfo=conn_str) as pool:
+            tiktok = BenchTikTok(session, limiter)
+            if args.s3:
+                async with aioboto3.Session().client("s3", endpoint_url=s3_endpoint, aws_access_key_id="bench", aws_secret_access_key="bench", region_name="us-east-1") as s3:
+                    await s3.create_bucket(Bucket="bench")
+                    main.BUCKET = "bench"
+                    media_cache = MediaCache(pool, "bench", limiter=limiter)
+                    upload_all = timer.wrap("s3", main.upload_all_to_s3)
+
+                    # the same hook main() installs with UPLOAD_MEDIA
+                    async def upload(post, users):
+                        await upload_all(s3, session, tiktok, post, users, media_cache)
+
+                    started = time.perf_counter()
+                    await main.process_posts(tiktok, pool, posts, concurrency=args.concurrency, upload=upload)
+            else:
+                started = time.perf_counter()
+                await main.process_posts(tiktok, pool, posts, concurrency=args.concurrency)
+            elapsed = time.perf_counter() - started
+    finally:
+        await fake.stop()
+        if s3_server:
+            s3_server.stop()
+        if pg_server:
+            pg_server.cleanup()
+
+    comments = args.posts * args.comments * (1 + args.replies)
+    print(f"posts={args.posts} comments/post={args.comments} replies/comment={args.replies} concurrency={args.concurrency}")
+    print(f"  elapsed    {elapsed:.2f}s")
+    print(f"  posts/s    {args.posts / elapsed:.1f}")
+    print(f"  comments/s {comments / elapsed:.0f}")
+    print(f"  requests   {fake.requests} ({fake.throttled} throttled)")
+    timer.report()
+    print(f"  peak RSS   {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="End-to-end pipeline benchmark against local stand-ins")
+    parser.add_argument("--posts", type=int, default=50)
+    parser.add_argument("--comments", type=int, default=200)
+    parser.add_argument("--replies", type=int, default=5)
+    parser.add_argument("--reply-depth", type=int, default=2)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.0, help="mean injected response latency in seconds")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of requests answered with 429")
+    parser.add_argument("--rate", type=float, default=1000, help="limiter requests per second for the stub host")
+    parser.add_argument("--host-concurrency", type=int, default=64)
+    parser.add_argument("--s3", action="store_true", help="also stream videos and media to a local S3 stand-in")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))
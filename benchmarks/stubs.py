@@ -0,0 +1,139 @@
+import os
+import logging
+import random
+import asyncio
+import tempfile
+from aiohttp import web
+
+def user(index, base_url):
+    return {
+        "uid": f"u{index}",
+        "unique_id": f"user{index}",
+        "nickname": f"User {index}",
+        "signature": "",
+        "region": "US",
+        "avatar_thumb": {"url_list": [f"{base_url}/avatar/u{index}.jpeg?x-signature={random.random()}"]}
+    }
+
+class FakeTikTok:
+    # serves synthetic comment and reply pages plus media blobs, with optional latency and 429 injection
+    def __init__(self, comments=200, replies=5, reply_depth=2, users=1000, latency=0.0, throttle_rate=0.0, video_size=2 * 1024 * 1024, image_size=8 * 1024):
+        self.comments = comments
+        self.replies = replies
+        self.reply_depth = reply_depth
+        self.users = users
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.video_body = os.urandom(video_size)
+        self.image_body = os.urandom(image_size)
+        self.requests = 0
+        self.throttled = 0
+        self.base_url = None
+        self.runner = None
+
+    async def __delay(self):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(random.expovariate(1 / self.latency))
+        if self.throttle_rate and random.random() < self.throttle_rate:
+            self.throttled += 1
+            raise web.HTTPTooManyRequests(headers={"Retry-After": "0"})
+
+    def __user(self, post_id, index):
+        return user(hash((post_id, index)) % self.users, self.base_url)
+
+    async def comment_list(self, request):
+        await self.__delay()
+        post_id = request.query["aweme_id"]
+        cursor, count = int(request.query["cursor"]), int(request.query["count"])
+        comments = [{
+            "cid": f"{post_id}-{i}",
+            "user": self.__user(post_id, i),
+            "create_time": 1700000000 + i,
+            "digg_count": i % 97,
+            "reply_comment_total": self.replies,
+            "text": f"comment {i} on {post_id}",
+            "is_author_digged": i % 11 == 0
+        } for i in range(cursor, min(cursor + count, self.comments))]
+        return web.json_response({"comments": comments, "has_more": int(cursor + count < self.comments), "cursor": cursor + count})
+
+    async def reply_list(self, request):
+        await self.__delay()
+        post_id, comment_id = request.query["item_id"], request.query["comment_id"]
+        cursor, count = int(request.query["cursor"]), int(request.query["count"])
+        replies = []
+        for j in range(cursor, min(cursor + count, self.replies)):
+            reply = {
+                "cid": f"{comment_id}-r{j}",
+                "user": self.__user(post_id, j + 7),
+                "create_time": 1700000100 + j,
+                "digg_count": j,
+                "text": f"reply {j}",
+                "is_author_digged": False,
+                "reply_id": comment_id
+            }
+            if j % self.reply_depth:
+                reply["reply_to_reply_id"] = f"{comment_id}-r{j - 1}"
+                reply["reply_to_userid"] = "u0"
+            replies.append(reply)
+        return web.json_response({"comments": replies, "has_more": int(cursor + count < self.replies), "cursor": cursor + count})
+
+    async def video(self, request):
+        await self.__delay()
+        return web.Response(body=self.video_body, content_type="video/mp4")
+
+    async def image(self, request):
+        await self.__delay()
+        return web.Response(body=self.image_body, content_type="image/jpeg", headers={"ETag": '"static"'})
+
+    async def start(self, host="localhost", port=0):
+        app = web.Application()
+        app.router.add_get("/api/comment/list/", self.comment_list)
+        app.router.add_get("/api/comment/list/reply", self.reply_list)
+        app.router.add_get("/video/media/wmplay/{post_id}.mp4", self.video)
+        app.router.add_get("/avatar/{name}", self.image)
+        app.router.add_get("/thumbnail/{name}", self.image)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://{host}:{port}"
+        return self.base_url
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    def post(self, index):
+        return {
+            "id": f"bench{index}",
+            "title": f"benchmark post {index}",
+            "author": {"id": "creator"},
+            "width": 576,
+            "height": 1024,
+            "duration": 15,
+            "likes_count": index,
+            "plays_count": index * 10,
+            "reposts_count": 0,
+            "shares_count": 0,
+            "created": 1700000000,
+            "thumbnail": f"{self.base_url}/thumbnail/bench{index}.png"
+        }
+
+def start_s3():
+    # moto is only needed for benchmarks, so it is imported here rather than listed in requirements
+    from moto.server import ThreadedMotoServer
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = ThreadedMotoServer(ip_address="localhost", port=0)
+    server.start()
+    host, port = server.get_host_and_port()
+    return server, f"http://{host}:{port}"
+
+def start_postgres():
+    # uses BENCH_PG_CONN_STR when set, otherwise a throwaway pgserver instance in a temp dir
+    conn_str = os.environ.get("BENCH_PG_CONN_STR")
+    if conn_str:
+        return None, conn_str
+    import pgserver
+    server = pgserver.get_server(tempfile.mkdtemp(prefix="bench-pg-"), cleanup_mode="delete")
+    return server, server.get_uri()
@@ -0,0 +1,11 @@
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# settings shared by the crawler (main.py), the refresh tool and the comment scan, each entrypoint reads its own settings itself
+CONCURRENCY = int(os.environ.get("CONCURRENCY") or 8)
+HTTP_CACHE_MODE = os.environ.get("HTTP_CACHE_MODE") or "passthrough"
+HTTP_CACHE_DIR = os.environ.get("HTTP_CACHE_DIR") or ".http_cache"
+# minimum similarity for approximate keyword matches, e.g. 0.8; unset matches keywords exactly only
+FUZZY_MATCH = float(os.environ["FUZZY_MATCH"]) if os.environ.get("FUZZY_MATCH") else None
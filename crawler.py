@@ -0,0 +1,107 @@
+import os
+import json
+import asyncio
+from collections import deque
+from metrics import metrics
+
+# the last cursor of a creator whose feed has been read to the end
+DONE = "done"
+
+class CreatorCrawler:
+    # crawls the feeds of many creators concurrently into one stream of posts, posts shared between creators
+    # are yielded once, and each creator's cursor is checkpointed only once every post of its page is done
+    def __init__(self, tiktok, path="creators.json", concurrency=4, queue_size=8):
+        self.tiktok = tiktok
+        self.path = path
+        self.concurrency = concurrency
+        # pages, not posts, buffered between the producers and the consumer
+        self.queue_size = queue_size
+        self.cursors = {}
+        self.seen = set()
+        # sec_uid -> pages yielded but not checkpointed yet, oldest first
+        self.pages = {}
+        # post id -> (sec_uid, page) entries still waiting for it
+        self.waiting = {}
+
+    def load(self):
+        try:
+            with open(self.path) as file:
+                self.cursors = json.load(file)
+        except FileNotFoundError:
+            self.cursors = {}
+
+    def save(self):
+        temp = f"{self.path}.tmp"
+        with open(temp, "w") as file:
+            json.dump(self.cursors, file)
+        os.replace(temp, self.path)
+
+    def done(self, post_id):
+        # called once a yielded post is committed, enqueued or deliberately dropped; a post that failed is never done,
+        # so its creator is crawled again from that page on the next run
+        for sec_uid, page in self.waiting.pop(post_id, ()):
+            page["remaining"].discard(post_id)
+            self.__advance(sec_uid)
+
+    def __advance(self, sec_uid):
+        pages = self.pages.get(sec_uid)
+        advanced = False
+        while pages and pages[0]["read"] and not pages[0]["remaining"]:
+            cursor = pages.popleft()["cursor"]
+            self.cursors[sec_uid] = DONE if cursor is None else cursor
+            advanced = True
+        if advanced:
+            self.save()
+
+    async def __produce(self, sec_uid, queue, semaphore):
+        async with semaphore:
+            try:
+                async for posts, cursor in self.tiktok.iter_video_pages(sec_uid, self.cursors.get(sec_uid) or 0):
+                    await queue.put((sec_uid, posts, cursor))
+            except Exception as e:
+                metrics.inc("creators_failed_total")
+                print("Error crawling", sec_uid, e)
+
+    async def crawl(self, sec_uids, restart=False):
+        if restart:
+            self.cursors = {}
+        self.pages = {}
+        self.waiting = {}
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        pending = [sec_uid for sec_uid in dict.fromkeys(sec_uids) if self.cursors.get(sec_uid) != DONE]
+        producers = [asyncio.create_task(self.__produce(sec_uid, queue, semaphore)) for sec_uid in pending]
+
+        async def close():
+            await asyncio.gather(*producers)
+            await queue.put(None)
+
+        closer = asyncio.create_task(close())
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                sec_uid, posts, cursor = item
+                page = {"cursor": cursor, "remaining": set(), "read": False}
+                self.pages.setdefault(sec_uid, deque()).append(page)
+                for post in posts:
+                    id_ = post["id"]
+                    if id_ in self.seen:
+                        metrics.inc("crawled_duplicates_total")
+                        # yielded for another creator's page and not done yet, this page waits for it as well
+                        if id_ in self.waiting:
+                            page["remaining"].add(id_)
+                            self.waiting[id_].append((sec_uid, page))
+                        continue
+                    self.seen.add(id_)
+                    page["remaining"].add(id_)
+                    self.waiting[id_] = [(sec_uid, page)]
+                    metrics.inc("crawled_posts_total")
+                    yield post
+                page["read"] = True
+                self.__advance(sec_uid)
+        finally:
+            closer.cancel()
+            for producer in producers:
+                producer.cancel()
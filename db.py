@@ -1,4 +1,5 @@
 import os
+import time
 import psycopg
 from dotenv import load_dotenv
 
@@ -6,62 +7,145 @@ load_dotenv()
 
 DB_CONN = str(os.environ.get("PG_CONN_STR"))
 
+SCHEMA = [
+    """
+        CREATE TABLE IF NOT EXISTS users (
+            id TEXT NOT NULL PRIMARY KEY,
+            username TEXT NOT NULL,
+            nickname TEXT,
+            bio TEXT,
+            region TEXT,
+            scraped TIMESTAMP
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS posts (
+            id TEXT NOT NULL PRIMARY KEY,
+            title TEXT,
+            author TEXT NOT NULL,
+            format TEXT,
+            width INT,
+            height INT,
+            duration INT,
+            likes_count INT,
+            plays_count INT,
+            reposts_count INT,
+            shares_count INT,
+            created TIMESTAMP,
+            scraped TIMESTAMP,
+            deleted BOOL
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS comments (
+            id TEXT NOT NULL PRIMARY KEY,
+            post TEXT NOT NULL,
+            author TEXT NOT NULL,
+            created TIMESTAMP,
+            text TEXT,
+            likes_count INT,
+            liked_by_author BOOL,
+            parent TEXT,
+            scraped TIMESTAMP,
+            deleted BOOL,
+            FOREIGN KEY (author) REFERENCES users(id),
+            FOREIGN KEY (parent) REFERENCES comments(id),
+            FOREIGN KEY (post) REFERENCES posts(id)
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS media (
+            key TEXT NOT NULL PRIMARY KEY,
+            source_url TEXT,
+            source_etag TEXT,
+            content_md5 TEXT,
+            uploaded TIMESTAMP
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS comment_matches (
+            comment TEXT NOT NULL,
+            term TEXT NOT NULL,
+            PRIMARY KEY (comment, term),
+            FOREIGN KEY (comment) REFERENCES comments(id)
+        )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_comments_id ON comments (id)",
+    "CREATE INDEX IF NOT EXISTS idx_posts_id ON posts (id)",
+    "CREATE INDEX IF NOT EXISTS idx_users_id ON users (id)",
+    "CREATE INDEX IF NOT EXISTS idx_media_content_md5 ON media (content_md5)",
+    "CREATE INDEX IF NOT EXISTS idx_comments_post ON comments (post)",
+    "CREATE INDEX IF NOT EXISTS idx_comments_parent ON comments (parent)",
+    "CREATE INDEX IF NOT EXISTS idx_users_scraped ON users (scraped)",
+    "CREATE INDEX IF NOT EXISTS idx_posts_scraped ON posts (scraped)",
+    "CREATE INDEX IF NOT EXISTS idx_comments_scraped ON comments (scraped)"
+]
+
 def get_or_create_db():
     conn = psycopg.connect(DB_CONN)
     try:
         with conn.cursor() as cur:
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    id TEXT NOT NULL PRIMARY KEY,
-                    username TEXT NOT NULL,
-                    nickname TEXT,
-                    bio TEXT,
-                    region TEXT,
-                    scraped TIMESTAMP
-                )
-            """)
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS posts (
-                    id TEXT NOT NULL PRIMARY KEY,
-                    title TEXT,
-                    author TEXT NOT NULL,
-                    format TEXT,
-                    width INT,
-                    height INT,
-                    duration INT,
-                    likes_count INT,
-                    plays_count INT,
-                    reposts_count INT,
-                    shares_count INT,
-                    created TIMESTAMP,
-                    scraped TIMESTAMP,
-                    deleted BOOL
-                )
-            """)
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS comments (
-                    id TEXT NOT NULL PRIMARY KEY,
-                    post TEXT NOT NULL,
-                    author TEXT NOT NULL,
-                    created TIMESTAMP,
-                    text TEXT,
-                    likes_count INT,
-                    liked_by_author BOOL,
-                    parent TEXT,
-                    scraped TIMESTAMP,
-                    deleted BOOL,
-                    FOREIGN KEY (author) REFERENCES users(id),
-                    FOREIGN KEY (parent) REFERENCES comments(id),
-                    FOREIGN KEY (post) REFERENCES posts(id)
-                )
-            """)
-
-            cur.execute("CREATE INDEX IF NOT EXISTS idx_comments_id ON comments (id)")
-            cur.execute("CREATE INDEX IF NOT EXISTS idx_posts_id ON posts (id)")
-            cur.execute("CREATE INDEX IF NOT EXISTS idx_users_id ON users (id)")
-
+            for query in SCHEMA:
+                cur.execute(query)
         conn.commit()
     except Exception as e:
         conn.rollback()
         raise e
     return conn
+
+def user_rows(users):
+    # users are normalize.UserRecord, whose first five fields are the users columns
+    return [user[:5] for user in users]
+
+def post_row(post):
+    return (post['id'], post['title'], post['author']['id'], post['width'], post['height'], post.get('format'), post['duration'], post['likes_count'], post['plays_count'], post['reposts_count'], post['shares_count'], post['created'])
+
+def comment_rows(post, comments):
+    # comments are normalize.CommentRecord, already laid out as comments rows
+    return comments
+
+def insert_all_to_db(conn, users, post, comments):
+    users_query = "INSERT INTO users (id, username, nickname, bio, region, scraped) VALUES (%s, %s, %s, %s, %s, now()) ON CONFLICT (id) DO NOTHING"
+    post_query = "INSERT INTO posts (id, title, author, width, height, format, duration, likes_count, plays_count, reposts_count, shares_count, created, scraped) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, to_timestamp(%s), now()) ON CONFLICT (id) DO NOTHING"
+    comments_query = "INSERT INTO comments (id, post, author, created, likes_count, text, liked_by_author, parent, scraped) VALUES (%s, %s, %s, to_timestamp(%s), %s, %s, %s, %s, now()) ON CONFLICT (id) DO NOTHING"
+
+    with conn.cursor() as cur:
+        cur.executemany(users_query, user_rows(users))
+        cur.execute(post_query, post_row(post))
+        cur.executemany(comments_query, comment_rows(post, comments))
+    return conn
+
+# temp tables are session-local and never WAL-logged, ON COMMIT DELETE ROWS empties them after every merge
+STAGING_TABLES = [
+    "CREATE TEMP TABLE IF NOT EXISTS staging_users (id TEXT, username TEXT, nickname TEXT, bio TEXT, region TEXT) ON COMMIT DELETE ROWS",
+    "CREATE TEMP TABLE IF NOT EXISTS staging_posts (id TEXT, title TEXT, author TEXT, width INT, height INT, format TEXT, duration INT, likes_count INT, plays_count INT, reposts_count INT, shares_count INT, created BIGINT) ON COMMIT DELETE ROWS",
+    "CREATE TEMP TABLE IF NOT EXISTS staging_comments (id TEXT, post TEXT, author TEXT, created BIGINT, likes_count INT, text TEXT, liked_by_author BOOL, parent TEXT) ON COMMIT DELETE ROWS",
+]
+
+MERGE_QUERIES = [
+    "INSERT INTO users (id, username, nickname, bio, region, scraped) SELECT id, username, nickname, bio, region, now() FROM staging_users ON CONFLICT (id) DO NOTHING",
+    "INSERT INTO posts (id, title, author, width, height, format, duration, likes_count, plays_count, reposts_count, shares_count, created, scraped) SELECT id, title, author, width, height, format, duration, likes_count, plays_count, reposts_count, shares_count, to_timestamp(created), now() FROM staging_posts ON CONFLICT (id) DO NOTHING",
+    "INSERT INTO comments (id, post, author, created, likes_count, text, liked_by_author, parent, scraped) SELECT id, post, author, to_timestamp(created), likes_count, text, liked_by_author, parent, now() FROM staging_comments ON CONFLICT (id) DO NOTHING",
+]
+
+class WriteBuffer:
+    # collects (users, post, comments) until flush_size rows or flush_interval seconds have built up;
+    # writers take() the batch and write it in one transaction
+    def __init__(self, flush_size=5000, flush_interval=5.0):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.batch = []
+        self.rows = 0
+        self.last_flush = time.monotonic()
+
+    def add(self, users, post, comments):
+        self.batch.append((users, post, comments))
+        self.rows += len(users) + len(comments) + 1
+
+    def due(self):
+        return bool(self.batch) and (self.rows >= self.flush_size or time.monotonic() - self.last_flush >= self.flush_interval)
+
+    def take(self):
+        batch, self.batch, self.rows = self.batch, [], 0
+        self.last_flush = time.monotonic()
+        return batch
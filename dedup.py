@@ -0,0 +1,125 @@
+import os
+import math
+import time
+import struct
+import hashlib
+from datetime import datetime, timedelta
+
+HEADER = struct.Struct("<QQQ")
+
+class BloomFilter:
+    def __init__(self, capacity=1_000_000, error_rate=0.001):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def __positions(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self.__positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.__positions(key))
+
+    def save(self, path):
+        temp = f"{path}.tmp"
+        with open(temp, "wb") as file:
+            file.write(HEADER.pack(self.size, self.hashes, self.count))
+            file.write(self.bits)
+        os.replace(temp, path)
+
+    @classmethod
+    def load(cls, path):
+        bloom = cls.__new__(cls)
+        with open(path, "rb") as file:
+            bloom.size, bloom.hashes, bloom.count = HEADER.unpack(file.read(HEADER.size))
+            bloom.bits = bytearray(file.read())
+        return bloom
+
+async def filter_unseen(pool, ids):
+    # anti-join on the server so only the candidate ids cross the wire, never the whole posts table
+    async with pool.connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("CREATE TEMP TABLE IF NOT EXISTS candidate_posts (id TEXT) ON COMMIT DELETE ROWS")
+            async with cur.copy("COPY candidate_posts (id) FROM STDIN") as copy:
+                for id_ in ids:
+                    await copy.write_row((id_,))
+            await cur.execute("SELECT c.id FROM candidate_posts c WHERE NOT EXISTS (SELECT 1 FROM posts p WHERE p.id = c.id)")
+            unseen = {row[0] for row in await cur.fetchall()}
+    return [id_ for id_ in ids if id_ in unseen]
+
+class ProcessedFilter:
+    # the filter is saved with a watermark, the latest posts.scraped it has taken in; every load, and every
+    # sync_interval seconds after that, posts written since the watermark by any process are added, so a filter
+    # saved long ago (or not at all after a crash) still only misses ids that really are new
+    def __init__(self, pool, path="processed.bloom", capacity=1_000_000, error_rate=0.001, sync_interval=60, overlap=600):
+        self.pool = pool
+        self.path = path
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.sync_interval = sync_interval
+        # transactions that were still open when the watermark was read have an earlier scraped, so they are re-read
+        self.overlap = timedelta(seconds=overlap)
+        self.bloom = None
+        self.watermark = None
+        self.synced = 0
+
+    async def load(self):
+        # the filter is persisted between runs and only rebuilt from posts when the file is missing
+        self.watermark = None
+        if self.path and os.path.exists(self.path):
+            self.bloom = BloomFilter.load(self.path)
+            try:
+                with open(f"{self.path}.watermark") as file:
+                    self.watermark = datetime.fromisoformat(file.read().strip())
+            except FileNotFoundError:
+                pass
+        else:
+            async with self.pool.connection() as conn:
+                count = (await (await conn.execute("SELECT count(*) FROM posts")).fetchone())[0]
+            self.bloom = BloomFilter(max(self.capacity, count * 2), self.error_rate)
+        await self.sync()
+
+    async def sync(self):
+        # without a watermark every post is read
+        async with self.pool.connection() as conn:
+            async with conn.cursor(name="processed_posts") as cur:
+                if self.watermark is None:
+                    await cur.execute("SELECT id, scraped FROM posts")
+                else:
+                    await cur.execute("SELECT id, scraped FROM posts WHERE scraped > %s", (self.watermark - self.overlap,))
+                async for id_, scraped in cur:
+                    self.bloom.add(id_)
+                    if scraped and (self.watermark is None or scraped > self.watermark):
+                        self.watermark = scraped
+        self.synced = time.monotonic()
+
+    async def unseen(self, ids):
+        # bloom misses are new as of the last sync, only possible hits are confirmed against the database
+        if time.monotonic() - self.synced >= self.sync_interval:
+            await self.sync()
+        maybe_seen = [id_ for id_ in ids if id_ in self.bloom]
+        if not maybe_seen:
+            return list(ids)
+        still_unseen = set(await filter_unseen(self.pool, maybe_seen))
+        maybe_seen = set(maybe_seen)
+        return [id_ for id_ in ids if id_ not in maybe_seen or id_ in still_unseen]
+
+    def add(self, id_):
+        self.bloom.add(id_)
+
+    def save(self):
+        # the watermark is written after the filter, an interrupted save leaves an older watermark, which only means a longer sync
+        if self.path:
+            self.bloom.save(self.path)
+            if self.watermark:
+                temp = f"{self.path}.watermark.tmp"
+                with open(temp, "w") as file:
+                    file.write(self.watermark.isoformat())
+                os.replace(temp, f"{self.path}.watermark")
@@ -1,5 +1,8 @@
 import re
+import math
 import difflib
+from functools import lru_cache
+from collections import defaultdict
 
 LEETSPEAK_MAP = {
     '4': 'a', '3': 'e', '1': 'i', '0': 'o', '@': 'a', '$': 's',
@@ -56,3 +59,156 @@ def detect_relevant_content(text, include_list, do_not_include_list=None, thresh
                             matches = [m for m in matches if m != match.group(0)]  # Remove this match
 
     return matches
+
+WORD_PATTERN = re.compile(r'\w+')
+FUZZY_TOKEN_PATTERN = re.compile(r'[\w@$+]+')
+
+def bounded_edit_distance(a, b, max_distance):
+    # Levenshtein distance restricted to a band of width max_distance; returns max_distance + 1 once it is exceeded
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i] + [max_distance + 1] * len(b)
+        low = max(1, i - max_distance)
+        high = min(len(b), i + max_distance)
+        for j in range(low, high + 1):
+            cost = 0 if char_a == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+        if min(current[max(0, low - 1):high + 1]) > max_distance:
+            return max_distance + 1
+        previous = current
+    return min(previous[len(b)], max_distance + 1)
+
+class FuzzyIndex:
+    def __init__(self, keywords, threshold=0.8, q=3, cache_size=65536):
+        # threshold is the minimum similarity 1 - distance / len(keyword), measured on leetspeak-normalized forms
+        self.q = q
+        self.keywords = {}
+        self.grams = defaultdict(list)
+        self.short = []
+        for index, keyword in keywords:
+            normalized = leetspeak_to_normal(keyword)
+            # the epsilon keeps float error from rounding an exact boundary down, (1 - 0.8) * 5 is 0.999...
+            max_distance = math.floor(len(normalized) * (1 - threshold) + 1e-9)
+            grams = self.__grams(normalized)
+            # every edit destroys at most q grams, so a match within max_distance shares at least this many
+            required = len(grams) - max_distance * self.q
+            self.keywords[index] = (normalized, max_distance, required)
+            if required > 0:
+                for gram in grams:
+                    self.grams[gram].append(index)
+            else:
+                self.short.append(index)
+        self.lookup = lru_cache(maxsize=cache_size)(self.__lookup)
+
+    def __grams(self, text):
+        padded = "#" * (self.q - 1) + text + "#" * (self.q - 1)
+        return {padded[i:i + self.q] for i in range(len(padded) - self.q + 1)}
+
+    def __lookup(self, token):
+        shared = defaultdict(int)
+        for gram in self.__grams(token):
+            for index in self.grams.get(gram, ()):
+                shared[index] += 1
+        candidates = [index for index, count in shared.items() if count >= self.keywords[index][2]]
+        candidates.extend(self.short)
+        found = []
+        for index in candidates:
+            normalized, max_distance, _ = self.keywords[index]
+            if bounded_edit_distance(token, normalized, max_distance) <= max_distance:
+                found.append(index)
+        return tuple(found)
+
+    @staticmethod
+    def tokenize(text):
+        # normalized -> original token, the first occurrence wins
+        tokens = {}
+        for token in FUZZY_TOKEN_PATTERN.findall(text):
+            tokens.setdefault(leetspeak_to_normal(token), token)
+        return tokens
+
+    def search(self, text, skip=()):
+        return self.search_tokens(self.tokenize(text), skip)
+
+    def search_tokens(self, tokens, skip=()):
+        # tokens as returned by tokenize, so a caller that already split the text does not split it again
+        hits = {}
+        for normalized, original in tokens.items():
+            for index in self.lookup(normalized):
+                if index not in skip and index not in hits:
+                    hits[index] = original
+        return hits
+
+class KeywordMatcher:
+    def __init__(self, include_list, do_not_include_list=None, fuzzy_threshold=None):
+        # fuzzy_threshold enables approximate matching of single-word keywords that did not match exactly
+        self.fuzzy_threshold = fuzzy_threshold
+        self.include = self.__compile(include_list, fuzzy_threshold)
+        self.deny = self.__compile(do_not_include_list or [], fuzzy_threshold)
+
+    @staticmethod
+    def __compile(keywords, fuzzy_threshold):
+        # keywords made only of word characters match exactly when a whole \w+ token equals them,
+        # so they are looked up by token; anything else falls back to a precompiled pattern
+        words = defaultdict(list)
+        patterns = []
+        for index, keyword in enumerate(keywords):
+            if WORD_PATTERN.fullmatch(keyword):
+                words[keyword.lower()].append(index)
+            elif " " in keyword:
+                patterns.append((index, re.compile(re.escape(keyword), re.IGNORECASE)))
+            else:
+                patterns.append((index, re.compile(r'\b' + re.escape(keyword) + r'\b', re.IGNORECASE)))
+        gate = re.compile("|".join(pattern.pattern for _, pattern in patterns), re.IGNORECASE) if patterns else None
+        fuzzy = None
+        if fuzzy_threshold is not None:
+            fuzzy = FuzzyIndex([(index, keyword) for index, keyword in enumerate(keywords) if " " not in keyword], fuzzy_threshold)
+        return dict(words), patterns, gate, fuzzy
+
+    def tokenize(self, text):
+        # (word tokens, fuzzy tokens); with fuzzy matching on the text is split once into [\w@$+]+ tokens,
+        # and the \w+ word tokens are the runs within them, in the same order a plain \w+ split finds them
+        words = {}
+        if self.fuzzy_threshold is None:
+            for token in WORD_PATTERN.findall(text):
+                words.setdefault(token.lower(), token)
+            return words, None
+        fuzzy = {}
+        seen = set()
+        for token in FUZZY_TOKEN_PATTERN.findall(text):
+            if token in seen:
+                continue
+            seen.add(token)
+            fuzzy.setdefault(leetspeak_to_normal(token), token)
+            for word in WORD_PATTERN.findall(token):
+                words.setdefault(word.lower(), word)
+        return words, fuzzy
+
+    def __scan(self, compiled, text, tokens, fuzzy_tokens):
+        words, patterns, gate, fuzzy = compiled
+        hits = []
+        if words:
+            for token, original in tokens.items():
+                for index in words.get(token, ()):
+                    hits.append((index, original))
+        if gate is not None and gate.search(text):
+            for index, pattern in patterns:
+                match = pattern.search(text)
+                if match:
+                    hits.append((index, match.group(0)))
+        if fuzzy is not None:
+            hits.extend(fuzzy.search_tokens(fuzzy_tokens, skip={index for index, _ in hits}).items())
+        hits.sort(key=lambda hit: hit[0])
+        return [match for _, match in hits]
+
+    def match(self, text):
+        tokens, fuzzy_tokens = self.tokenize(text)
+        matches = self.__scan(self.include, text, tokens, fuzzy_tokens)
+        if matches:
+            denied = set(self.__scan(self.deny, text, tokens, fuzzy_tokens))
+            if denied:
+                matches = [m for m in matches if m not in denied]
+        return matches
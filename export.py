@@ -0,0 +1,208 @@
+import os
+import json
+import time
+import pyarrow as pa
+import pyarrow.csv as csv
+import pyarrow.dataset as ds
+import pyarrow.fs as pafs
+from dotenv import load_dotenv
+from db import get_or_create_db
+
+load_dotenv()
+
+EXPORT_DIR = os.environ.get("EXPORT_DIR") or "export"
+EXPORT_FORMAT = os.environ.get("EXPORT_FORMAT") or "parquet"
+EXPORT_PARTITION = os.environ.get("EXPORT_PARTITION") or "date"
+EXPORT_CHUNK_SIZE = int(os.environ.get("EXPORT_CHUNK_SIZE") or 50000)
+
+SCHEMAS = {
+    "users": pa.schema([
+        ("id", pa.string()),
+        ("username", pa.string()),
+        ("nickname", pa.string()),
+        ("bio", pa.string()),
+        ("region", pa.string()),
+        ("scraped", pa.timestamp("us")),
+    ]),
+    "posts": pa.schema([
+        ("id", pa.string()),
+        ("title", pa.string()),
+        ("author", pa.string()),
+        ("format", pa.string()),
+        ("width", pa.int32()),
+        ("height", pa.int32()),
+        ("duration", pa.int32()),
+        ("likes_count", pa.int32()),
+        ("plays_count", pa.int32()),
+        ("reposts_count", pa.int32()),
+        ("shares_count", pa.int32()),
+        ("created", pa.timestamp("us")),
+        ("scraped", pa.timestamp("us")),
+        ("deleted", pa.bool_()),
+    ]),
+    "comments": pa.schema([
+        ("id", pa.string()),
+        ("post", pa.string()),
+        ("author", pa.string()),
+        ("created", pa.timestamp("us")),
+        ("text", pa.string()),
+        ("likes_count", pa.int32()),
+        ("liked_by_author", pa.bool_()),
+        ("parent", pa.string()),
+        ("scraped", pa.timestamp("us")),
+        ("deleted", pa.bool_()),
+    ]),
+}
+
+# the hive partition column each table is split on; users are small enough to stay in one directory
+PARTITIONS = {
+    "date": {"posts": ("date", pa.date32(), "created::date"), "comments": ("date", pa.date32(), "created::date")},
+    "post": {"posts": ("date", pa.date32(), "created::date"), "comments": ("post_id", pa.string(), "post")},
+}
+
+def load_state(path):
+    try:
+        with open(os.path.join(path, "_state.json")) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+def save_state(path, state):
+    temp = os.path.join(path, "_state.json.tmp")
+    with open(temp, "w") as file:
+        json.dump(state, file)
+    os.replace(temp, os.path.join(path, "_state.json"))
+
+class CopyStream:
+    # file-like view of a COPY TO STDOUT for arrow's csv reader; COPY hands out one row per chunk,
+    # so reads gather chunks up to the requested size instead of returning them one by one
+    def __init__(self, copy):
+        self.chunks = iter(copy)
+        self.pending = b""
+        self.total = 0
+        self.closed = False
+
+    def read(self, size=-1):
+        parts = [self.pending]
+        length = len(self.pending)
+        while size < 0 or length < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            parts.append(chunk)
+            length += len(chunk)
+        data = b"".join(parts)
+        if size < 0:
+            size = length
+        data, self.pending = data[:size], data[size:]
+        self.total += len(data)
+        return data
+
+def iter_copy(conn, query, params, schema, chunk_size=EXPORT_CHUNK_SIZE):
+    # COPY streams rows as csv and arrow parses the blocks natively, no per-row python objects are created;
+    # postgres writes NULL as an empty field and an empty string as "", booleans as t/f
+    read_options = csv.ReadOptions(column_names=schema.names, block_size=chunk_size * 256)
+    parse_options = csv.ParseOptions(newlines_in_values=True)
+    convert_options = csv.ConvertOptions(column_types=schema, null_values=[""], strings_can_be_null=True, quoted_strings_can_be_null=False, true_values=["t"], false_values=["f"])
+    with conn.cursor() as cur:
+        with cur.copy(f"COPY ({query}) TO STDOUT (FORMAT csv)", params) as copy:
+            stream = CopyStream(copy)
+            try:
+                reader = csv.open_csv(stream, read_options, parse_options, convert_options)
+            except pa.ArrowInvalid:
+                # arrow refuses an empty input, which here just means there are no rows
+                if stream.total:
+                    raise
+                return
+            for batch in reader:
+                yield batch
+
+def read_table(conn, query, params, schema):
+    return pa.Table.from_batches(list(iter_copy(conn, query, params, schema)), schema=schema)
+
+def iter_batches(conn, table, schema, partition, since, until, chunk_size):
+    selected = ", ".join(schema.names)
+    if partition:
+        selected += f", {partition[2]}"
+        schema = schema.append(pa.field(partition[0], partition[1]))
+    query = f"SELECT {selected} FROM {table} WHERE scraped <= %s"
+    params = [until]
+    if since:
+        query += " AND scraped > %s"
+        params.append(since)
+    else:
+        # rows inserted before scraped was recorded only go out with a full export
+        query += " OR scraped IS NULL"
+    return iter_copy(conn, query, params, schema, chunk_size)
+
+def export_table(conn, path, table, format=EXPORT_FORMAT, partition_by=EXPORT_PARTITION, since=None, until=None, chunk_size=EXPORT_CHUNK_SIZE):
+    # every run writes new uniquely named files next to the old ones, so an incremental export only appends
+    schema = SCHEMAS[table]
+    partition = PARTITIONS[partition_by].get(table)
+    partitioning = ds.partitioning(pa.schema([pa.field(partition[0], partition[1])]), flavor="hive") if partition else None
+    if format == "parquet":
+        file_options = ds.ParquetFileFormat().make_write_options(compression="zstd")
+    else:
+        # uncompressed IPC buffers can be memory-mapped and used in place
+        file_options = ds.IpcFileFormat().make_write_options(compression=None)
+    batches = iter_batches(conn, table, schema, partition, since, until, chunk_size)
+    rows = 0
+
+    def counted():
+        nonlocal rows
+        for batch in batches:
+            rows += batch.num_rows
+            yield batch
+
+    ds.write_dataset(
+        counted(),
+        os.path.join(path, table),
+        schema=schema.append(pa.field(partition[0], partition[1])) if partition else schema,
+        format=format,
+        partitioning=partitioning,
+        file_options=file_options,
+        basename_template=f"part-{time.time_ns()}-{{i}}.{'parquet' if format == 'parquet' else 'arrow'}",
+        existing_data_behavior="overwrite_or_ignore",
+        max_partitions=1 << 20,
+        max_open_files=256,
+        max_rows_per_group=1 << 20,
+    )
+    return rows
+
+def export_all(conn, path=EXPORT_DIR, format=EXPORT_FORMAT, partition_by=EXPORT_PARTITION, full=False, settle=60):
+    # the watermark stops settle seconds in the past, so rows from a flush that was still committing
+    # during the export are picked up by the next run rather than skipped
+    os.makedirs(path, exist_ok=True)
+    state = {} if full else load_state(path)
+    if state and (state.get("format"), state.get("partition")) != (format, partition_by):
+        raise ValueError(f"{path} was exported as {state.get('format')} by {state.get('partition')}, run a full export into a new directory")
+    until = conn.execute("SELECT now()::timestamp - make_interval(secs => %s)", (settle,)).fetchone()[0]
+    counts = {}
+    for table in SCHEMAS:
+        counts[table] = export_table(conn, path, table, format, partition_by, state.get(table), until)
+        state[table] = until.isoformat()
+    conn.commit()
+    state["format"], state["partition"] = format, partition_by
+    save_state(path, state)
+    return counts
+
+def open_export(path, table):
+    # lazy dataset over one exported table; IPC files are read through mmap so columns are not copied
+    state = load_state(path)
+    format = state.get("format", EXPORT_FORMAT)
+    partition = PARTITIONS[state.get("partition", EXPORT_PARTITION)].get(table)
+    partitioning = ds.partitioning(pa.schema([pa.field(partition[0], partition[1])]), flavor="hive") if partition else None
+    filesystem = pafs.LocalFileSystem(use_mmap=format != "parquet")
+    return ds.dataset(os.path.join(path, table), format=format, partitioning=partitioning, filesystem=filesystem)
+
+def main():
+    conn = get_or_create_db()
+    try:
+        counts = export_all(conn)
+    finally:
+        conn.close()
+    for table, rows in counts.items():
+        print("Exported", rows, table)
+
+if __name__ == "__main__":
+    main()
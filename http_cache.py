@@ -0,0 +1,116 @@
+import os
+import json
+import time
+import zlib
+import asyncio
+import hashlib
+import threading
+import urllib.parse
+
+# signature and tracking params change on every request without changing the response
+VOLATILE_PARAMS = {"X-Bogus", "msToken", "verifyFp", "WebIdLastTime", "_signature"}
+
+class CacheMiss(LookupError):
+    pass
+
+# returned by load() when there is no usable entry, a cached body may itself be JSON null
+MISS = object()
+
+class HTTPCache:
+    # record: serve unexpired entries and fetch and store misses
+    # replay: serve entries only, a miss raises CacheMiss, so runs are fully offline
+    # passthrough: never read or write the cache
+    MODES = ("record", "replay", "passthrough")
+
+    def __init__(self, path=".http_cache", mode="record", ttl=None, max_bytes=1 << 30):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown cache mode {mode}, expected one of {self.MODES}")
+        self.path = path
+        self.mode = mode
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        # measured by one walk of the tree on the first store, then kept up to date by store and evict
+        self.total_bytes = None
+        self.lock = threading.Lock()
+
+    def key(self, url, params=None):
+        parsed = urllib.parse.urlparse(url)
+        query = urllib.parse.parse_qsl(parsed.query) + [(k, str(v)) for k, v in (params or {}).items() if v is not None]
+        query = sorted((k, v) for k, v in query if k not in VOLATILE_PARAMS)
+        normalized = parsed._replace(query=urllib.parse.urlencode(query), fragment="").geturl()
+        return hashlib.sha256(normalized.encode()).hexdigest()
+
+    def __file(self, key):
+        return os.path.join(self.path, key[:2], f"{key}.json.z")
+
+    def load(self, url, params=None):
+        file = self.__file(self.key(url, params))
+        try:
+            if self.ttl is not None and self.mode != "replay" and time.time() - os.path.getmtime(file) > self.ttl:
+                return MISS
+            with open(file, "rb") as f:
+                return json.loads(zlib.decompress(f.read()))
+        except FileNotFoundError:
+            return MISS
+
+    def store(self, url, params, body):
+        # load and store block on disk and zlib, get_json runs them in worker threads
+        file = self.__file(self.key(url, params))
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        data = zlib.compress(json.dumps(body, separators=(",", ":"), ensure_ascii=False).encode())
+        temp = f"{file}.{threading.get_ident()}.tmp"
+        with open(temp, "wb") as f:
+            f.write(data)
+        with self.lock:
+            if self.total_bytes is None:
+                self.total_bytes = sum(size for _, _, size in self.__entries())
+            try:
+                replaced = os.path.getsize(file)
+            except FileNotFoundError:
+                replaced = 0
+            os.replace(temp, file)
+            self.total_bytes += len(data) - replaced
+            if self.total_bytes > self.max_bytes:
+                self.__evict()
+
+    def __entries(self):
+        for root, _, files in os.walk(self.path):
+            for name in files:
+                if name.endswith(".json.z"):
+                    file = os.path.join(root, name)
+                    try:
+                        stat = os.stat(file)
+                    except FileNotFoundError:
+                        continue
+                    yield stat.st_mtime, file, stat.st_size
+
+    def evict(self, target=0.9):
+        with self.lock:
+            self.__evict(target)
+
+    def __evict(self, target=0.9):
+        # drops the oldest entries until the cache is back under target * max_bytes
+        entries = sorted(self.__entries())
+        total = sum(size for _, _, size in entries)
+        for _, file, size in entries:
+            if total <= self.max_bytes * target:
+                break
+            try:
+                os.remove(file)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self.total_bytes = total
+
+    async def get_json(self, fetch, url, params=None):
+        # fetch is a zero-argument coroutine function that performs the real request
+        if self.mode == "passthrough":
+            return await fetch()
+        body = await asyncio.to_thread(self.load, url, params)
+        if body is not MISS:
+            return body
+        if self.mode == "replay":
+            raise CacheMiss(url)
+        body = await fetch()
+        await asyncio.to_thread(self.store, url, params, body)
+        return body
@@ -1,14 +1,21 @@
 import os
-import json
-import operator as op
 import asyncio
+from functools import lru_cache
 import aiohttp
 import aioboto3
 from dotenv import load_dotenv
 from tiktok import TikTok
-from detection import detect_relevant_content
-from db import get_or_create_db
-from utils import extract_mime_type, get_list, fetch_resource, topological_sort
+from http_cache import HTTPCache
+from detection import KeywordMatcher
+from async_db import open_pool, AsyncBulkWriter
+from dedup import ProcessedFilter
+from crawler import CreatorCrawler
+from work_queue import WorkQueue
+from media_cache import MediaCache
+from metrics import metrics
+from s3 import stream_upload
+from utils import extract_mime_type, get_list, iter_json_items
+from config import CONCURRENCY, HTTP_CACHE_MODE, HTTP_CACHE_DIR, FUZZY_MATCH
 
 load_dotenv()
 
@@ -18,84 +25,205 @@ ACCESS_KEY_ID = os.environ.get("S3_ACCESS_KEY_ID")
 SECRET_ACCESS_KEY = os.environ.get("S3_SECRET_ACCESS_KEY")
 REGION = os.environ.get("S3_REGION")
 DB_CONN = os.environ.get("PG_CONN_STR")
+QUEUE_SIZE = int(os.environ.get("QUEUE_SIZE") or 16)
+FLUSH_SIZE = int(os.environ.get("FLUSH_SIZE") or 5000)
+FLUSH_INTERVAL = float(os.environ.get("FLUSH_INTERVAL") or 5)
+PROCESSED_FILTER = os.environ.get("PROCESSED_FILTER") or "processed.bloom"
+METRICS_PORT = os.environ.get("METRICS_PORT")
+METRICS_FILE = os.environ.get("METRICS_FILE")
+CREATORS = os.environ.get("CREATORS")
+CREATOR_CHECKPOINTS = os.environ.get("CREATOR_CHECKPOINTS") or "creators.json"
+QUEUE_MODE = os.environ.get("QUEUE_MODE") or "local"
+QUEUE_DRAIN = (os.environ.get("QUEUE_DRAIN") or "true").lower() == "true"
+UPLOAD_MEDIA = (os.environ.get("UPLOAD_MEDIA") or "false").lower() == "true"
 
-def get_all_items_in_db(conn):
-    with conn.cursor() as cur:
-        result = cur.execute("SELECT id FROM posts").fetchall()
-        return [row[0] for row in result]
+async def upload_video(s3, tiktok, post):
+    await stream_upload(s3, BUCKET, f"video/{post['id']}", tiktok.stream_video(post['id']), "video/mp4")
 
-def insert_all_to_db(conn, users, post, comments):
-    users_data = [(user['id'], user['username'], user['nickname'], user['bio'], user['region']) for user in users]
-    posts_data = (post['id'], post['title'], post['author']['id'], post['width'], post['height'], post.get('format'), post['duration'], post['likes_count'], post['plays_count'], post['reposts_count'], post['shares_count'], post['created'])
-    comments_data = [(comment['id'], post['id'], comment['author']['id'], comment['created'], comment['likes_count'], comment['text'], comment['liked_by_creator'], comment.get('parent')) for comment in comments]
-
-    users_query = "INSERT INTO users (id, username, nickname, bio, region) VALUES (%s, %s, %s, %s, %s) ON CONFLICT (id) DO NOTHING"
-    post_query = "INSERT INTO posts (id, title, author, width, height, format, duration, likes_count, plays_count, reposts_count, shares_count, created) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, to_timestamp(%s)) ON CONFLICT (id) DO NOTHING"
-    comments_query = "INSERT INTO comments (id, post, author, created, likes_count, text, liked_by_author, parent) VALUES (%s, %s, %s, to_timestamp(%s), %s, %s, %s, %s) ON CONFLICT (id) DO NOTHING"
-
-    with conn.cursor() as cur:
-        cur.executemany(users_query, users_data)
-        cur.execute(post_query, posts_data)
-        cur.executemany(comments_query, comments_data)
-    return conn
-
-async def upload_video(s3, post, video):
-    await s3.put_object(Bucket=BUCKET, Key=f"video/{post['id']}", Body=video, ContentType="video/mp4")
-
-async def fetch_and_upload_thumbnail(s3, session, post):
+async def fetch_and_upload_thumbnail(s3, session, post, media_cache):
     thumbnail_key = f"thumbnail/{post['id']}"
-    thumbnail = await fetch_resource(session, post['thumbnail'])
     thumbnail_content_type = "image/png"
-    await s3.put_object(Bucket=BUCKET, Key=thumbnail_key, Body=thumbnail, ContentType=thumbnail_content_type)
+    await media_cache.upload(s3, session, thumbnail_key, post['thumbnail'], thumbnail_content_type)
 
-async def fetch_and_upload_avatar(s3, session, user):
-    avatar_key = f"avatar/{user['id']}"
-    avatar = await fetch_resource(session, user['avatar'])
-    avatar_content_type = extract_mime_type(user['avatar'])
-    await s3.put_object(Bucket=BUCKET, Key=avatar_key, Body=avatar, ContentType=avatar_content_type)
+async def fetch_and_upload_avatar(s3, session, user, media_cache):
+    avatar_key = f"avatar/{user.id}"
+    avatar_content_type = extract_mime_type(user.avatar)
+    await media_cache.upload(s3, session, avatar_key, user.avatar, avatar_content_type)
 
-async def upload_all_to_s3(s3, session, post, users, video):
-    await upload_video(s3, post, video)
-    await fetch_and_upload_thumbnail(s3, session, post)
-    await asyncio.gather(*[fetch_and_upload_avatar(s3, session, user) for user in users])
+async def upload_all_to_s3(s3, session, tiktok, post, users, media_cache):
+    await upload_video(s3, tiktok, post)
+    await fetch_and_upload_thumbnail(s3, session, post, media_cache)
+    await asyncio.gather(*[fetch_and_upload_avatar(s3, session, user, media_cache) for user in users])
 
-def analyze_comment_and_replies(comments):
-    include_list = get_list("include.txt")
+@lru_cache(maxsize=None)
+def include_matcher():
+    # the keyword list is read and compiled once per process
+    return KeywordMatcher(get_list("include.txt"), fuzzy_threshold=FUZZY_MATCH)
+
+def analyze_comment_and_replies(comments, matcher=None):
+    # comments are normalize.CommentRecord with replies already flattened in, see scan.py for whole-table scans
+    if matcher is None:
+        matcher = include_matcher()
     for comment in comments:
-        if "text" in comment:
-            text = comment['text']
-            relevant = detect_relevant_content(text.lower(), include_list)
+        if comment.text:
+            relevant = matcher.match(comment.text)
             if relevant:
-                print(f"({relevant}) {text}\n")
-        if "replies" in comment:
-            analyze_comment_and_replies(comment["replies"])
+                print(f"({relevant}) {comment.text}\n")
+
+async def fetch_post(tiktok, post, upload=None):
+    # upload(post, users) stores the post's media before the post is handed to the writer
+    normalizer = await tiktok.get_normalized_comments(post['id'])
+    users = list(normalizer.users.values())
+    comments = normalizer.comments
+    if upload:
+        await upload(post, users)
+    return post, users, comments
+
+async def iter_posts(posts):
+    # posts come from a plain iterable (video_items.json) or an async one (the creator crawler)
+    if hasattr(posts, "__aiter__"):
+        async for post in posts:
+            yield post
+    else:
+        for post in posts:
+            yield post
+
+async def feed_posts(posts, inbox, concurrency):
+    async for post in iter_posts(posts):
+        await inbox.put(post)
+    for _ in range(concurrency):
+        await inbox.put(None)
+
+async def fetch_worker(tiktok, inbox, queue, work_queue=None, upload=None):
+    # each worker pulls the next post from the inbox when it is free
+    while True:
+        post = await inbox.get()
+        metrics.set("queue_depth", inbox.qsize(), queue="inbox")
+        if post is None:
+            break
+        try:
+            result = await fetch_post(tiktok, post, upload)
+        except Exception as e:
+            metrics.inc("posts_failed_total", stage="fetch")
+            print("Error processing", post['id'], e)
+            if work_queue:
+                await work_queue.fail(post['id'], e)
+            continue
+        await queue.put(result)
+        metrics.set("queue_depth", queue.qsize(), queue="writer")
+
+async def db_writer(pool, queue, processed_filter=None, flush_size=FLUSH_SIZE, flush_interval=FLUSH_INTERVAL, work_queue=None, on_processed=None):
+    # posts are batched into one COPY + merge transaction per flush_size rows or flush_interval seconds,
+    # on_processed is called with each post id once its transaction has committed
+    writer = AsyncBulkWriter(pool, flush_size, flush_interval)
+    finished = False
+    while not finished:
+        try:
+            item = await asyncio.wait_for(queue.get(), timeout=flush_interval)
+            metrics.set("queue_depth", queue.qsize(), queue="writer")
+        except asyncio.TimeoutError:
+            item = ()
+        if item is None:
+            finished = True
+        elif item:
+            post, users, comments = item
+            writer.add(users, post, comments)
+        if finished or writer.due():
+            processed, failed = await writer.flush()
+            for post_id in processed:
+                if processed_filter:
+                    processed_filter.add(post_id)
+                if on_processed:
+                    on_processed(post_id)
+                metrics.inc("posts_processed_total")
+                print("Processed", post_id)
+            for post_id, e in failed:
+                metrics.inc("posts_failed_total", stage="db")
+                print("Error processing", post_id, e)
+                if work_queue:
+                    await work_queue.fail(post_id, e)
+            if work_queue:
+                await work_queue.complete(processed)
+
+async def process_posts(tiktok, pool, posts, processed_filter=None, concurrency=CONCURRENCY, queue_size=QUEUE_SIZE, work_queue=None, on_processed=None, upload=None):
+    # posts are pulled lazily through a bounded inbox, and fetch workers block on the bounded queue when the writer falls behind
+    inbox = asyncio.Queue(maxsize=concurrency)
+    queue = asyncio.Queue(maxsize=queue_size)
+    writer = asyncio.create_task(db_writer(pool, queue, processed_filter, work_queue=work_queue, on_processed=on_processed))
+    try:
+        await asyncio.gather(feed_posts(posts, inbox, concurrency), *[fetch_worker(tiktok, inbox, queue, work_queue, upload) for _ in range(concurrency)])
+        await queue.put(None)
+        await writer
+    finally:
+        writer.cancel()
+
+async def select_posts(posts, matcher, processed_filter, batch_size=1000, on_skipped=None):
+    # relevance is checked per post, already-processed ids are filtered a batch at a time;
+    # on_skipped is called with the id of every post that is not passed on
+    batch = []
+    async for post in iter_posts(posts):
+        if len(matcher.match(post['title'])) != 0:
+            batch.append(post)
+        elif on_skipped:
+            on_skipped(post['id'])
+        if len(batch) >= batch_size:
+            unseen = set(await processed_filter.unseen([post['id'] for post in batch]))
+            for post in batch:
+                if post['id'] in unseen:
+                    yield post
+                elif on_skipped:
+                    on_skipped(post['id'])
+            batch = []
+    if batch:
+        unseen = set(await processed_filter.unseen([post['id'] for post in batch]))
+        for post in batch:
+            if post['id'] in unseen:
+                yield post
+            elif on_skipped:
+                on_skipped(post['id'])
 
 async def main():
     async with aiohttp.ClientSession() as session:
-        tiktok = TikTok(session)
-        with get_or_create_db() as conn:
-            async with aioboto3.Session().resource(service_name="s3",endpoint_url=ENDPOINT,aws_access_key_id=ACCESS_KEY_ID,aws_secret_access_key=SECRET_ACCESS_KEY,region_name=REGION) as s3:
-            # async with s3.client(service_name="s3",endpoint_url=ENDPOINT,aws_access_key_id=ACCESS_KEY_ID,aws_secret_access_key=SECRET_ACCESS_KEY,region_name=REGION)
-                with open("video_items.json", "r") as file:
-                    posts = json.loads(file.read())
-                    include_list = get_list("include.txt")
-                    deny_list = get_list("do_not_include.txt")
-                    already_processed = get_all_items_in_db(conn)
-                    posts = [post for post in posts if post['id'] not in already_processed and len(detect_relevant_content(post['title'], include_list, deny_list)) != 0]
-                    for post in posts:
-                        if post['id'] not in already_processed:
-                                try:
-                                    # video = await tiktok.get_video(post['id'])
-                                    comments = await tiktok.get_comments_replies(post['id'], "flat")
-                                    comments = topological_sort(comments)
-                                    users = list({comment["author"]["id"]: comment["author"] for comment in comments}.values())
-                                    # await upload_all_to_s3(s3, session, post, users, video)
-                                    insert_all_to_db(conn, users, post, comments)
-                                    conn.commit()
-                                    print("Processed", post['id'])
-                                except Exception as e:
-                                    print("Error processing", post['id'], e)
+        tiktok = TikTok(session, cache=HTTPCache(HTTP_CACHE_DIR, HTTP_CACHE_MODE))
+        async with await open_pool() as pool:
+            async with aioboto3.Session().client(service_name="s3",endpoint_url=ENDPOINT,aws_access_key_id=ACCESS_KEY_ID,aws_secret_access_key=SECRET_ACCESS_KEY,region_name=REGION) as s3:
+                matcher = KeywordMatcher(get_list("include.txt"), get_list("do_not_include.txt"), FUZZY_MATCH)
+                processed_filter = ProcessedFilter(pool, PROCESSED_FILTER)
+                await processed_filter.load()
+                # videos, thumbnails and avatars go to S3 only with UPLOAD_MEDIA, before their post is committed
+                upload = None
+                if UPLOAD_MEDIA:
+                    media_cache = MediaCache(pool, BUCKET)
+
+                    async def upload(post, users):
+                        await upload_all_to_s3(s3, session, tiktok, post, users, media_cache)
+                # "enqueue" loads the shared work queue, "worker" processes from it on any number of nodes,
+                # "local" selects and processes posts in this process only
+                work_queue = WorkQueue(pool) if QUEUE_MODE != "local" else None
+                if work_queue:
+                    await work_queue.create()
+                # a crawled creator's checkpoint only moves past posts that were committed, enqueued or skipped
+                done = None
+                if QUEUE_MODE == "worker":
+                    posts = work_queue.posts(drain=QUEUE_DRAIN)
+                else:
+                    if CREATORS:
+                        crawler = CreatorCrawler(tiktok, CREATOR_CHECKPOINTS)
+                        crawler.load()
+                        source = crawler.crawl(CREATORS.split(","))
+                        done = crawler.done
+                    else:
+                        source = iter_json_items("video_items.json")
+                    posts = select_posts(source, matcher, processed_filter, on_skipped=done)
+                try:
+                    async with metrics.export(METRICS_PORT, METRICS_FILE):
+                        if QUEUE_MODE == "enqueue":
+                            print("Enqueued", await work_queue.enqueue(posts, on_enqueued=done))
+                        else:
+                            await process_posts(tiktok, pool, posts, processed_filter, work_queue=work_queue, on_processed=done, upload=upload)
+                finally:
+                    processed_filter.save()
             # with open("comments.json", "w") as file:
             #     file.write(json.dumps(comments, indent=4, ensure_ascii=False))
 if __name__ == "__main__":
-    asyncio.run(main())
+    asyncio.run(main())
\ No newline at end of file
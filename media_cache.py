@@ -0,0 +1,86 @@
+import hashlib
+import urllib.parse
+from collections import OrderedDict
+from ratelimit import default_limiter
+from metrics import metrics
+
+def normalize_source(url):
+    # CDN urls carry expiring signatures in the query string, the path identifies the image
+    return urllib.parse.urlparse(url)._replace(query="", fragment="").geturl()
+
+class MediaCache:
+    def __init__(self, pool, bucket, lru_size=100_000, limiter=default_limiter):
+        self.pool = pool
+        self.bucket = bucket
+        self.lru_size = lru_size
+        self.limiter = limiter
+        self.recent = OrderedDict()
+
+    def __remember(self, key, source):
+        self.recent[key] = source
+        self.recent.move_to_end(key)
+        if len(self.recent) > self.lru_size:
+            self.recent.popitem(last=False)
+
+    async def seed_from_bucket(self, s3, prefix=""):
+        # S3 ETags of single-part uploads are the MD5 of the body, which is what content_md5 stores
+        paginator = s3.get_paginator("list_objects_v2")
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cur:
+                async for response in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+                    rows = [(content["Key"], content["ETag"].strip('"')) for content in response.get("Contents", [])]
+                    await cur.executemany("INSERT INTO media (key, content_md5) VALUES (%s, %s) ON CONFLICT (key) DO NOTHING", rows)
+
+    async def __lookup(self, key):
+        async with self.pool.connection() as conn:
+            cur = await conn.execute("SELECT source_url, source_etag, content_md5 FROM media WHERE key = %s", (key,))
+            return await cur.fetchone()
+
+    async def __find_by_content(self, content_md5):
+        async with self.pool.connection() as conn:
+            cur = await conn.execute("SELECT key FROM media WHERE content_md5 = %s LIMIT 1", (content_md5,))
+            row = await cur.fetchone()
+            return row[0] if row else None
+
+    async def __record(self, key, source, etag, content_md5):
+        async with self.pool.connection() as conn:
+            await conn.execute("""
+                INSERT INTO media (key, source_url, source_etag, content_md5, uploaded) VALUES (%s, %s, %s, %s, now())
+                ON CONFLICT (key) DO UPDATE SET source_url = EXCLUDED.source_url, source_etag = EXCLUDED.source_etag, content_md5 = EXCLUDED.content_md5, uploaded = now()
+            """, (key, source, etag, content_md5))
+
+    async def __fetch(self, session, url, etag):
+        headers = {"If-None-Match": etag} if etag else {}
+        async with self.limiter.get(session, url, headers=headers) as response:
+            if response.status == 304:
+                return None, etag
+            return await response.read(), response.headers.get("ETag")
+
+    async def upload(self, s3, session, key, url, content_type):
+        # returns True only when bytes were actually sent to S3
+        source = normalize_source(url)
+        if self.recent.get(key) == source:
+            self.recent.move_to_end(key)
+            return False
+        entry = await self.__lookup(key)
+        if entry and entry[0] == source:
+            self.__remember(key, source)
+            return False
+        body, etag = await self.__fetch(session, url, entry[1] if entry else None)
+        if body is None:
+            await self.__record(key, source, etag, entry[2])
+            self.__remember(key, source)
+            return False
+        content_md5 = hashlib.md5(body).hexdigest()
+        uploaded = False
+        if not entry or entry[2] != content_md5:
+            existing = await self.__find_by_content(content_md5)
+            if existing:
+                await s3.copy_object(Bucket=self.bucket, Key=key, CopySource={"Bucket": self.bucket, "Key": existing}, ContentType=content_type, MetadataDirective="REPLACE")
+            else:
+                await s3.put_object(Bucket=self.bucket, Key=key, Body=body, ContentType=content_type)
+                metrics.inc("s3_bytes_uploaded_total", len(body))
+                uploaded = True
+        await self.__record(key, source, etag, content_md5)
+        self.__remember(key, source)
+        return uploaded
@@ -0,0 +1,146 @@
+import json
+import time
+import bisect
+import asyncio
+from contextlib import contextmanager, asynccontextmanager, nullcontext
+from aiohttp import web
+
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+DISABLED_TIMER = nullcontext()
+
+def escape_label(value):
+    # the text exposition format only allows \\, \" and \n escapes inside label values
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    # every recording method returns immediately while disabled, so instrumented code pays one attribute check
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        if not self.enabled:
+            return
+        self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def timer(self, name, **labels):
+        if not self.enabled:
+            return DISABLED_TIMER
+        return self.__timer(name, labels)
+
+    @contextmanager
+    def __timer(self, name, labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    @staticmethod
+    def __labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{escape_label(v)}"' for k, v in pairs) + "}"
+
+    def prometheus(self):
+        lines = []
+        for kind, series in (("counter", self.counters), ("gauge", self.gauges)):
+            for name in sorted({name for name, _ in series}):
+                lines.append(f"# TYPE {name} {kind}")
+                for (series_name, labels), value in series.items():
+                    if series_name == name:
+                        lines.append(f"{name}{self.__labels(labels)} {value}")
+        for name in sorted({name for name, _ in self.histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for (series_name, labels), histogram in self.histograms.items():
+                if series_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ("+Inf",), histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self.__labels(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{name}_sum{self.__labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{self.__labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        def series(items, value):
+            return [{"name": name, "labels": dict(labels), "value": value(item)} for (name, labels), item in items]
+        return {
+            "time": time.time(),
+            "counters": series(self.counters.items(), lambda value: value),
+            "gauges": series(self.gauges.items(), lambda value: value),
+            "histograms": series(self.histograms.items(), lambda h: {"buckets": dict(zip(map(str, BUCKETS + ("+Inf",)), h.counts)), "sum": h.sum, "count": h.count}),
+        }
+
+    async def serve(self, host="127.0.0.1", port=9100):
+        # exposes /metrics in the Prometheus text format, returns the runner so the caller can clean it up
+        async def handler(request):
+            return web.Response(text=self.prometheus(), content_type="text/plain")
+
+        app = web.Application()
+        app.router.add_get("/metrics", handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+    def dump(self, path):
+        with open(path, "w") as file:
+            json.dump(self.snapshot(), file)
+
+    async def dump_periodically(self, path, interval=10):
+        while True:
+            await asyncio.sleep(interval)
+            self.dump(path)
+
+    @asynccontextmanager
+    async def export(self, port=None, path=None, interval=10):
+        # enables collection only when there is somewhere to send it
+        if not port and not path:
+            yield self
+            return
+        self.enabled = True
+        runner = await self.serve(port=int(port)) if port else None
+        dumper = asyncio.create_task(self.dump_periodically(path, interval)) if path else None
+        try:
+            yield self
+        finally:
+            if dumper:
+                dumper.cancel()
+                self.dump(path)
+            if runner:
+                await runner.cleanup()
+
+metrics = Metrics()
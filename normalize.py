@@ -0,0 +1,62 @@
+from collections import namedtuple
+
+# field order matches the users and comments columns, so records go to the database as-is
+UserRecord = namedtuple("UserRecord", "id username nickname bio region avatar")
+CommentRecord = namedtuple("CommentRecord", "id post author created likes_count text liked_by_author parent")
+
+class CommentNormalizer:
+    # turns raw API comments and replies into records in one pass: users are interned by id, duplicates dropped,
+    # and comments come out parent before child, a reply waits only until its parent has been emitted
+    def __init__(self, post_id):
+        self.post_id = post_id
+        self.users = {}
+        self.comments = []
+        self.seen = set()
+        self.waiting = {}
+        # top-level comments whose replies were fetched in full, see TikTok.get_normalized_comments
+        self.threads = set()
+        # set once every comment and reply page was read to its end
+        self.complete = False
+
+    def __user(self, raw):
+        user = self.users.get(raw["uid"])
+        if user is None:
+            user = self.users[raw["uid"]] = UserRecord(raw["uid"], raw["unique_id"], raw["nickname"], raw["signature"], raw["region"], raw["avatar_thumb"]["url_list"][0])
+        return user.id
+
+    def __emit(self, record):
+        self.seen.add(record.id)
+        self.comments.append(record)
+        children = self.waiting.pop(record.id, None) if self.waiting else None
+        if not children:
+            return
+        stack = list(reversed(children))
+        while stack:
+            record = stack.pop()
+            if record.id in self.seen:
+                continue
+            self.seen.add(record.id)
+            self.comments.append(record)
+            stack.extend(reversed(self.waiting.pop(record.id, ())))
+
+    def add_comment(self, raw):
+        if raw["cid"] in self.seen:
+            return
+        self.__emit(CommentRecord(raw["cid"], self.post_id, self.__user(raw["user"]), raw["create_time"], raw["digg_count"], raw["text"], raw["is_author_digged"], None))
+
+    def add_reply(self, raw):
+        if raw["cid"] in self.seen:
+            return
+        # reply_to_reply_id is "0" for a direct reply to the top-level comment
+        parent = raw.get("reply_to_reply_id")
+        if not parent or parent == "0":
+            parent = raw["reply_id"]
+        record = CommentRecord(raw["cid"], self.post_id, self.__user(raw["user"]), raw["create_time"], raw["digg_count"], raw["text"], raw["is_author_digged"], parent)
+        if parent in self.seen:
+            self.__emit(record)
+        else:
+            self.waiting.setdefault(parent, []).append(record)
+
+    def orphans(self):
+        # replies whose parent never arrived, they are left out of comments like topological_sort did
+        return [record for records in self.waiting.values() for record in records]
@@ -0,0 +1,147 @@
+import time
+import random
+import asyncio
+import urllib.parse
+from contextlib import asynccontextmanager
+import aiohttp
+from metrics import metrics
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+RETRYABLE_ERRORS = (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError)
+
+# (requests per second, burst, max concurrency) keyed by registrable domain
+HOST_LIMITS = {
+    "tiktok.com": (5, 10, 16),
+    "tikwm.com": (2, 4, 4),
+    "tiktokcdn.com": (20, 40, 32),
+    "tiktokcdn-us.com": (20, 40, 32),
+}
+DEFAULT_HOST_LIMIT = (10, 20, 16)
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class HostLimiter:
+    def __init__(self, rate, burst, max_concurrency, min_rate=0.2, latency_target=5.0):
+        self.bucket = TokenBucket(rate, burst)
+        self.max_rate = rate
+        self.min_rate = min_rate
+        self.max_concurrency = max_concurrency
+        self.concurrency = float(max_concurrency)
+        self.latency_target = latency_target
+        self.in_flight = 0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.concurrency))
+            self.in_flight += 1
+        try:
+            await self.bucket.acquire()
+        except BaseException:
+            # a request cancelled while it waits for a token gives its slot back, or the host would stall at its limit
+            await self.release()
+            raise
+
+    async def release(self):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def increase(self, latency):
+        # additive increase while the host keeps up, multiplicative decrease once latency degrades
+        if latency > self.latency_target:
+            self.concurrency = max(1.0, self.concurrency * 0.75)
+            return
+        self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+        self.bucket.rate = min(self.max_rate, self.bucket.rate + 0.1)
+
+    def decrease(self):
+        self.concurrency = max(1.0, self.concurrency / 2)
+        self.bucket.rate = max(self.min_rate, self.bucket.rate / 2)
+
+class RateLimiter:
+    def __init__(self, retries=5, backoff_base=0.5, backoff_cap=60.0, host_limits=None):
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.host_limits = host_limits or HOST_LIMITS
+        self.hosts = {}
+
+    @staticmethod
+    def host_key(url):
+        hostname = urllib.parse.urlparse(url).hostname or ""
+        return ".".join(hostname.split(".")[-2:])
+
+    def host(self, url):
+        key = self.host_key(url)
+        if key not in self.hosts:
+            self.hosts[key] = HostLimiter(*self.host_limits.get(key, DEFAULT_HOST_LIMIT))
+        return self.hosts[key]
+
+    def backoff(self, attempt, retry_after=None):
+        delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, float(retry_after))
+        return delay
+
+    @asynccontextmanager
+    async def get(self, session, url, **kwargs):
+        # yields a response that already passed raise_for_status, retrying throttled and transient failures
+        host = self.host(url)
+        host_key = self.host_key(url)
+        attempt = 0
+        while True:
+            retry_after = None
+            # acquire() releases its own slot if it fails, so only a slot actually held is released below
+            await host.acquire()
+            try:
+                started = time.monotonic()
+                try:
+                    response = await session.get(url, **kwargs)
+                except RETRYABLE_ERRORS:
+                    metrics.inc("http_requests_total", host=host_key, status="error")
+                    if attempt >= self.retries:
+                        raise
+                    host.decrease()
+                else:
+                    # time to headers, the caller's body (a whole video download, say) says nothing about how the host copes
+                    latency = time.monotonic() - started
+                    metrics.inc("http_requests_total", host=host_key, status=response.status)
+                    metrics.observe("http_request_seconds", latency, host=host_key)
+                    if response.status in RETRYABLE_STATUSES and attempt < self.retries:
+                        retry_after = response.headers.get("Retry-After")
+                        response.release()
+                        host.decrease()
+                    else:
+                        try:
+                            response.raise_for_status()
+                            host.increase(latency)
+                            # the slot stays held while the body is read, it bounds the open connections to the host
+                            yield response
+                        finally:
+                            response.release()
+                        return
+            finally:
+                await host.release()
+            metrics.inc("http_retries_total", host=host_key)
+            await asyncio.sleep(self.backoff(attempt, retry_after))
+            attempt += 1
+
+default_limiter = RateLimiter()
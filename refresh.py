@@ -0,0 +1,137 @@
+import os
+import asyncio
+import aiohttp
+from tiktok import TikTok
+from http_cache import HTTPCache
+from async_db import open_pool
+from db import STAGING_TABLES, MERGE_QUERIES, user_rows
+from metrics import metrics
+from config import CONCURRENCY, HTTP_CACHE_MODE, HTTP_CACHE_DIR
+
+REFRESH_LIMIT = int(os.environ.get("REFRESH_LIMIT") or 1000)
+REFRESH_MIN_AGE = float(os.environ.get("REFRESH_MIN_AGE") or 86400)
+
+STALE_POSTS_QUERY = """
+    SELECT id FROM posts
+    WHERE deleted IS NOT TRUE AND (scraped IS NULL OR scraped < now() - make_interval(secs => %s))
+    ORDER BY scraped NULLS FIRST
+    LIMIT %s
+"""
+
+# replies store their direct parent only, the recursive walk from each top-level comment recovers its thread
+THREADS = """
+    WITH RECURSIVE tree AS (
+        SELECT id, id AS root FROM comments WHERE post = %(post)s AND parent IS NULL
+        UNION ALL
+        SELECT c.id, t.root FROM comments c JOIN tree t ON c.parent = t.id WHERE c.post = %(post)s
+    )
+"""
+
+REPLY_COUNTS_QUERY = THREADS + """
+    SELECT t.root, count(*) FILTER (WHERE t.id <> t.root AND c.deleted IS NOT TRUE)
+    FROM tree t JOIN comments c ON c.id = t.id
+    GROUP BY t.root
+"""
+
+STAGING_REFRESH = [
+    "CREATE TEMP TABLE IF NOT EXISTS staging_seen (id TEXT PRIMARY KEY) ON COMMIT DELETE ROWS",
+    "CREATE TEMP TABLE IF NOT EXISTS staging_threads (id TEXT PRIMARY KEY) ON COMMIT DELETE ROWS",
+]
+
+# only rows whose counts changed, or that come back after being marked deleted, are rewritten and get a new scraped
+UPSERT_COMMENTS = """
+    INSERT INTO comments (id, post, author, created, likes_count, text, liked_by_author, parent, scraped)
+    SELECT id, post, author, to_timestamp(created), likes_count, text, liked_by_author, parent, now() FROM staging_comments
+    ON CONFLICT (id) DO UPDATE SET likes_count = EXCLUDED.likes_count, liked_by_author = EXCLUDED.liked_by_author, deleted = false, scraped = now()
+    WHERE (comments.likes_count, comments.liked_by_author, coalesce(comments.deleted, false)) IS DISTINCT FROM (EXCLUDED.likes_count, EXCLUDED.liked_by_author, false)
+"""
+
+# a stored comment is gone when it was not seen and either its top-level comment is gone too,
+# or its thread was fetched in full; threads skipped as unchanged keep their replies
+MARK_DELETED = THREADS + """
+    UPDATE comments c SET deleted = true, scraped = now()
+    FROM tree t
+    WHERE c.id = t.id AND c.deleted IS NOT TRUE
+        AND NOT EXISTS (SELECT 1 FROM staging_seen s WHERE s.id = c.id)
+        AND (NOT EXISTS (SELECT 1 FROM staging_seen s WHERE s.id = t.root) OR EXISTS (SELECT 1 FROM staging_threads h WHERE h.id = t.root))
+"""
+
+# only comments are refreshed, the post's own counts (likes, plays, shares, reposts) keep their first-scraped values
+MARK_SCRAPED = "UPDATE posts SET scraped = now() WHERE id = %(post)s"
+
+async def stale_posts(pool, limit=REFRESH_LIMIT, min_age=REFRESH_MIN_AGE):
+    # never-refreshed posts first, then the longest since their last scrape
+    async with pool.connection() as conn:
+        cur = await conn.execute(STALE_POSTS_QUERY, (min_age, limit))
+        return [row[0] for row in await cur.fetchall()]
+
+async def reply_counts(pool, post_id):
+    async with pool.connection() as conn:
+        cur = await conn.execute(REPLY_COUNTS_QUERY, {"post": post_id})
+        return dict(await cur.fetchall())
+
+async def write_refresh(pool, post_id, normalizer, known_replies):
+    # returns the number of comments marked deleted
+    async with pool.connection() as conn:
+        async with conn.cursor() as cur:
+            for query in STAGING_TABLES + STAGING_REFRESH:
+                await cur.execute(query)
+            async with cur.copy("COPY staging_users (id, username, nickname, bio, region) FROM STDIN") as copy:
+                for row in user_rows(normalizer.users.values()):
+                    await copy.write_row(row)
+            async with cur.copy("COPY staging_comments (id, post, author, created, likes_count, text, liked_by_author, parent) FROM STDIN") as copy:
+                for row in normalizer.comments:
+                    await copy.write_row(row)
+            async with cur.copy("COPY staging_seen (id) FROM STDIN") as copy:
+                # orphans were not stored but they do still exist, so they must not count as deleted
+                for id_ in {record.id for record in normalizer.comments} | {record.id for record in normalizer.orphans()}:
+                    await copy.write_row((id_,))
+            async with cur.copy("COPY staging_threads (id) FROM STDIN") as copy:
+                for id_ in normalizer.threads:
+                    await copy.write_row((id_,))
+            await cur.execute(MERGE_QUERIES[0])
+            await cur.execute(UPSERT_COMMENTS)
+            updated = cur.rowcount
+            deleted = 0
+            if not normalizer.complete:
+                # comments missing from a listing that was cut short may simply not have been read
+                print("Incomplete listing for", post_id, "keeping stored comments")
+            elif normalizer.comments or not known_replies:
+                await cur.execute(MARK_DELETED, {"post": post_id})
+                deleted = cur.rowcount
+            else:
+                # an empty listing for a post that had comments is more likely a failed fetch than a mass deletion
+                print("Empty listing for", post_id, "keeping stored comments")
+            await cur.execute(MARK_SCRAPED, {"post": post_id})
+        await conn.commit()
+    metrics.inc("comments_refreshed_total", updated)
+    metrics.inc("comments_deleted_total", deleted)
+    return updated, deleted
+
+async def refresh_post(tiktok, pool, post_id):
+    known_replies = await reply_counts(pool, post_id)
+    normalizer = await tiktok.get_normalized_comments(post_id, known_replies=known_replies)
+    return await write_refresh(pool, post_id, normalizer, known_replies)
+
+async def refresh_posts(tiktok, pool, post_ids, concurrency=CONCURRENCY):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def refresh(post_id):
+        async with semaphore:
+            try:
+                updated, deleted = await refresh_post(tiktok, pool, post_id)
+                print("Refreshed", post_id, updated, "updated", deleted, "deleted")
+            except Exception as e:
+                metrics.inc("posts_failed_total", stage="refresh")
+                print("Error refreshing", post_id, e)
+
+    await asyncio.gather(*[refresh(post_id) for post_id in post_ids])
+
+async def main():
+    async with aiohttp.ClientSession() as session:
+        tiktok = TikTok(session, cache=HTTPCache(HTTP_CACHE_DIR, HTTP_CACHE_MODE))
+        async with await open_pool() as pool:
+            await refresh_posts(tiktok, pool, await stale_posts(pool))
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,29 +1,213 @@
-from itertools import islice
+import asyncio
+import contextlib
+from datetime import timedelta
+from metrics import metrics
 
-async def list_all(s3, bucket):
+PART_SIZE = 8 * 1024 * 1024
+
+MEDIA_PREFIXES = ("video/", "thumbnail/", "avatar/")
+
+# the keys each media prefix should hold according to the database, sorted bytewise like S3 lists them
+EXPECTED_KEYS = {
+    "video/": "SELECT 'video/' || id FROM posts ORDER BY id COLLATE \"C\"",
+    "thumbnail/": "SELECT 'thumbnail/' || id FROM posts ORDER BY id COLLATE \"C\"",
+    "avatar/": "SELECT 'avatar/' || id FROM users ORDER BY id COLLATE \"C\"",
+}
+
+async def merge(generators, queue_size=1000):
+    # runs the async generators concurrently and yields their items as they arrive; the first error is raised at once
+    queue = asyncio.Queue(maxsize=queue_size)
+    done = object()
+
+    async def drain(generator):
+        try:
+            async for item in generator:
+                await queue.put((None, item))
+            await queue.put((done, None))
+        except Exception as e:
+            await queue.put((done, e))
+
+    tasks = [asyncio.create_task(drain(generator)) for generator in generators]
+    try:
+        remaining = len(tasks)
+        while remaining:
+            marker, item = await queue.get()
+            if marker is not done:
+                yield item
+            elif item is not None:
+                raise item
+            else:
+                remaining -= 1
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def iter_objects(s3, bucket, prefix=""):
+    # the listing's content dicts, with Key, LastModified, ETag and Size
     paginator = s3.get_paginator("list_objects_v2")
-    items = []
-    async for response in paginator.paginate(Bucket=bucket):
-        if "Contents" in response:
-            for content in response["Contents"]:
-                items.append(content["Key"])
-    return items
-
-async def delete_objcets(s3, bucket, objects_to_delete):
-    responses = []
-    batch_size = 1000
-    for i in range(0, len(objects_to_delete), batch_size):
-        batch = list(islice(objects_to_delete, i, i + batch_size))
-        response = await s3.delete_objects(
-            Bucket=bucket,
-            Delete={
-                'Objects': [{'Key': key} for key in batch],
-                'Quiet': False
-            }
-        )
-        responses.append(response)
-    return responses
+    async for response in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for content in response.get("Contents", []):
+            yield content
+
+async def iter_keys(s3, bucket, prefix=""):
+    async for content in iter_objects(s3, bucket, prefix):
+        yield content["Key"]
+
+async def list_keys(s3, bucket, prefixes=("",)):
+    # each prefix is listed by its own paginator, so listing runs len(prefixes) requests at a time
+    async for key in merge([iter_keys(s3, bucket, prefix) for prefix in prefixes]):
+        yield key
+
+async def list_all(s3, bucket, prefixes=("",)):
+    return [key async for key in list_keys(s3, bucket, prefixes)]
+
+async def delete_objects(s3, bucket, keys, concurrency=8, batch_size=1000):
+    # keys may be a plain or an async iterable and are batched as they arrive, up to concurrency
+    # delete_objects calls are in flight; returns (deleted count, [error dicts]) with every failure collected
+    pending = set()
+    deleted = 0
+    errors = []
+
+    async def delete(batch):
+        nonlocal deleted
+        try:
+            response = await s3.delete_objects(Bucket=bucket, Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True})
+        except Exception as e:
+            errors.extend({"Key": key, "Code": type(e).__name__, "Message": str(e)} for key in batch)
+            return
+        failed = response.get("Errors", [])
+        errors.extend(failed)
+        deleted += len(batch) - len(failed)
+        metrics.inc("s3_objects_deleted_total", len(batch) - len(failed))
+
+    async def submit(batch):
+        while len(pending) >= concurrency:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            pending.difference_update(done)
+        pending.add(asyncio.create_task(delete(batch)))
+
+    batch = []
+    try:
+        if hasattr(keys, "__aiter__"):
+            async for key in keys:
+                batch.append(key)
+                if len(batch) >= batch_size:
+                    await submit(batch)
+                    batch = []
+        else:
+            for key in keys:
+                batch.append(key)
+                if len(batch) >= batch_size:
+                    await submit(batch)
+                    batch = []
+        if batch:
+            await submit(batch)
+        await asyncio.gather(*pending)
+    except BaseException:
+        for task in pending:
+            task.cancel()
+        raise
+    return deleted, errors
+
+# kept for callers of the old misspelled name
+delete_objcets = delete_objects
+
+async def iter_expected_keys(pool, prefix, batch_size=10000):
+    async with pool.connection() as conn:
+        async with conn.cursor(name=f"expected_{prefix.strip('/')}") as cur:
+            await cur.execute(EXPECTED_KEYS[prefix])
+            while True:
+                rows = await cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row[0]
+
+async def diff_prefix(s3, pool, bucket, prefix, cutoff=None):
+    # merge-join of two sorted streams, memory stays constant however many keys there are;
+    # objects modified at or after cutoff are never reported as orphans
+    listed = iter_objects(s3, bucket, prefix)
+    expected = iter_expected_keys(pool, prefix)
+    content = await anext(listed, None)
+    wanted = await anext(expected, None)
+    while content is not None or wanted is not None:
+        key = content["Key"] if content is not None else None
+        if wanted is None or (key is not None and key.encode() < wanted.encode()):
+            if cutoff is None or content["LastModified"] < cutoff:
+                yield "orphan", key
+            else:
+                metrics.inc("s3_orphans_too_recent_total")
+            content = await anext(listed, None)
+        elif key is None or wanted.encode() < key.encode():
+            yield "missing", wanted
+            wanted = await anext(expected, None)
+        else:
+            content = await anext(listed, None)
+            wanted = await anext(expected, None)
+
+async def reconcile(s3, pool, bucket, prefixes=MEDIA_PREFIXES, grace=3600):
+    # yields ("orphan", key) for objects nothing in the database refers to and ("missing", key) for media
+    # the database expects but the bucket lacks; orphans can be passed straight to delete_objects.
+    # main uploads media before the writer commits its post, and the listing outlasts the database snapshot,
+    # so only objects last modified grace seconds before the snapshot count as orphans, even during a crawl
+    async with pool.connection() as conn:
+        snapshot = (await (await conn.execute("SELECT now()")).fetchone())[0]
+    cutoff = snapshot - timedelta(seconds=grace)
+    async for item in merge([diff_prefix(s3, pool, bucket, prefix, cutoff) for prefix in prefixes]):
+        yield item
+
+async def stream_upload(s3, bucket, key, chunks, content_type, part_size=PART_SIZE, max_pending=2):
+    # chunks is an async generator of bytes, closed here even when the upload fails so its response is released;
+    # parts upload while the next one is still downloading, at most max_pending parts in flight,
+    # so memory stays around (max_pending + 1) * part_size
+    upload_id = None
+    part_number = 0
+    parts = []
+    pending = set()
+    buffer = bytearray()
+
+    async def upload_part(number, body):
+        response = await s3.upload_part(Bucket=bucket, Key=key, PartNumber=number, UploadId=upload_id, Body=body)
+        metrics.inc("s3_bytes_uploaded_total", len(body))
+        parts.append({"PartNumber": number, "ETag": response["ETag"]})
+
+    async def submit(body):
+        nonlocal upload_id, part_number
+        if upload_id is None:
+            response = await s3.create_multipart_upload(Bucket=bucket, Key=key, ContentType=content_type)
+            upload_id = response["UploadId"]
+        while len(pending) >= max_pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            pending.difference_update(done)
+            for task in done:
+                task.result()
+        part_number += 1
+        pending.add(asyncio.create_task(upload_part(part_number, body)))
+
+    try:
+        async with contextlib.aclosing(chunks):
+            async for chunk in chunks:
+                buffer += chunk
+                while len(buffer) >= part_size:
+                    await submit(bytes(buffer[:part_size]))
+                    del buffer[:part_size]
+        if upload_id is None:
+            await s3.put_object(Bucket=bucket, Key=key, Body=bytes(buffer), ContentType=content_type)
+            metrics.inc("s3_bytes_uploaded_total", len(buffer))
+            return
+        if buffer:
+            await submit(bytes(buffer))
+        await asyncio.gather(*pending)
+        parts.sort(key=lambda part: part["PartNumber"])
+        await s3.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={"Parts": parts})
+    except BaseException:
+        for task in pending:
+            task.cancel()
+        if upload_id is not None:
+            await s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
 
 # sample usage
-# all = await list_all(s3, BUCKET)
-# removed = await delete_objcets(s3, BUCKET, all)
+# deleted, errors = await delete_objects(s3, BUCKET, list_keys(s3, BUCKET, MEDIA_PREFIXES))
+# orphans = (key async for kind, key in reconcile(s3, pool, BUCKET) if kind == "orphan")
+# deleted, errors = await delete_objects(s3, BUCKET, orphans)
@@ -0,0 +1,109 @@
+import os
+import json
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import psycopg
+from dotenv import load_dotenv
+from db import DB_CONN, get_or_create_db
+from detection import KeywordMatcher
+from utils import get_list
+from config import FUZZY_MATCH
+
+load_dotenv()
+
+SCAN_WORKERS = int(os.environ.get("SCAN_WORKERS") or os.cpu_count() or 1)
+SCAN_BATCH_SIZE = int(os.environ.get("SCAN_BATCH_SIZE") or 5000)
+SCAN_OUTPUT = os.environ.get("SCAN_OUTPUT")
+
+STAGING_MATCHES = "CREATE TEMP TABLE IF NOT EXISTS staging_comment_matches (comment TEXT, term TEXT) ON COMMIT DELETE ROWS"
+MERGE_MATCHES = "INSERT INTO comment_matches (comment, term) SELECT DISTINCT comment, term FROM staging_comment_matches ON CONFLICT (comment, term) DO NOTHING"
+
+# set once per worker process by init_worker, so keyword lists are read and compiled once rather than per batch
+matcher = None
+
+def init_worker(include_list, do_not_include_list, fuzzy_threshold):
+    global matcher
+    matcher = KeywordMatcher(include_list, do_not_include_list, fuzzy_threshold)
+
+def match_batch(rows):
+    # rows are (comment id, text); only comments with at least one match are sent back
+    results = []
+    for comment_id, text in rows:
+        if text:
+            matches = matcher.match(text)
+            if matches:
+                results.append((comment_id, matches))
+    return results
+
+def iter_comment_batches(conn, batch_size=SCAN_BATCH_SIZE, post=None):
+    # a named cursor keeps the result set on the server, only batch_size rows are held here at a time
+    query = "SELECT id, text FROM comments WHERE deleted IS NOT TRUE"
+    params = ()
+    if post:
+        query += " AND post = %s"
+        params = (post,)
+    with conn.cursor(name="scan_comments") as cur:
+        cur.itersize = batch_size
+        cur.execute(query, params)
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+
+class TableSink:
+    def __init__(self, conn):
+        self.conn = conn
+        self.count = 0
+
+    def write(self, results):
+        with self.conn.cursor() as cur:
+            cur.execute(STAGING_MATCHES)
+            with cur.copy("COPY staging_comment_matches (comment, term) FROM STDIN") as copy:
+                for comment_id, matches in results:
+                    for term in matches:
+                        copy.write_row((comment_id, term))
+            cur.execute(MERGE_MATCHES)
+        self.conn.commit()
+        self.count += len(results)
+
+class FileSink:
+    def __init__(self, file):
+        self.file = file
+        self.count = 0
+
+    def write(self, results):
+        self.file.writelines(json.dumps({"comment": comment_id, "matches": matches}, ensure_ascii=False) + "\n" for comment_id, matches in results)
+        self.count += len(results)
+
+def scan_comments(conn, sink, include_list, do_not_include_list=None, fuzzy_threshold=None, workers=SCAN_WORKERS, batch_size=SCAN_BATCH_SIZE, post=None):
+    # batches are dispatched to the pool as they are read; at most 2 per worker are in flight so memory stays bounded
+    # while every core has the next batch queued
+    pending = deque()
+    with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(include_list, do_not_include_list, fuzzy_threshold)) as pool:
+        for rows in iter_comment_batches(conn, batch_size, post):
+            if len(pending) >= workers * 2:
+                sink.write(pending.popleft().result())
+            pending.append(pool.submit(match_batch, rows))
+        while pending:
+            sink.write(pending.popleft().result())
+    conn.commit()
+    return sink.count
+
+def main():
+    include_list = get_list("include.txt")
+    do_not_include_list = get_list("do_not_include.txt")
+    conn = get_or_create_db()
+    try:
+        if SCAN_OUTPUT:
+            with open(SCAN_OUTPUT, "w") as file:
+                count = scan_comments(conn, FileSink(file), include_list, do_not_include_list, FUZZY_MATCH)
+        else:
+            with psycopg.connect(DB_CONN) as write_conn:
+                count = scan_comments(conn, TableSink(write_conn), include_list, do_not_include_list, FUZZY_MATCH)
+    finally:
+        conn.close()
+    print("Matched", count, "comments")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+@pytest.fixture(scope="session")
+def postgres():
+    # a throwaway pgserver instance (or BENCH_PG_CONN_STR), shared by every test that needs a database
+    pytest.importorskip("psycopg_pool")
+    from benchmarks.stubs import start_postgres
+    try:
+        server, conn_str = start_postgres()
+    except ImportError:
+        pytest.skip("pgserver is not installed")
+    yield conn_str
+    if server:
+        server.cleanup()
+
+@pytest.fixture(scope="session")
+def s3_endpoint():
+    # a local moto server standing in for S3
+    pytest.importorskip("moto")
+    from benchmarks.stubs import start_s3
+    server, endpoint = start_s3()
+    yield endpoint
+    server.stop()
@@ -0,0 +1,121 @@
+import psycopg
+import numpy as np
+import pyarrow as pa
+from db import SCHEMA
+from analytics import Engagement, create_aggregates, select, POST_COLUMNS, COMMENT_COLUMNS, USER_COLUMNS
+from export import SCHEMAS
+from utils import iter_thread
+
+def table(name, columns, rows):
+    schema = select(SCHEMAS[name], columns)
+    return pa.Table.from_pylist([dict(zip(columns, row)) for row in rows], schema=schema)
+
+def comments(rows):
+    # (id, post, author, created, likes_count, liked_by_author, parent)
+    return table("comments", COMMENT_COLUMNS, rows)
+
+POSTS = table("posts", POST_COLUMNS, [
+    ("p1", "u1", 10, 1000, 1, 2, 1_700_000_000_000_000),
+    ("p2", "u2", 0, 0, 0, 0, 1_700_000_000_000_000),
+])
+
+def engagement(rows, users=None):
+    return Engagement(POSTS, comments(rows), users)
+
+def depths(rows):
+    return dict(zip([row[0] for row in rows], engagement(rows).reply_depths().tolist()))
+
+def test_reply_depths_on_long_chain():
+    rows = [("c0", "p1", "u1", None, 0, False, None)] + [(f"r{i}", "p1", "u1", None, 0, False, f"r{i - 1}" if i > 1 else "c0") for i in range(1, 300)]
+    assert depths(rows) == {row[0]: i for i, row in enumerate(rows)}
+
+def test_reply_depths_match_threads():
+    # a chain, a parent cycle with a reply hanging off it, an orphan with a reply of its own, and a self-parented reply
+    rows = [
+        ("c", "p1", "u1", None, 0, False, None),
+        ("a", "p1", "u1", None, 0, False, "c"),
+        ("b", "p1", "u1", None, 0, False, "a"),
+        ("x", "p1", "u1", None, 0, False, "y"),
+        ("y", "p1", "u1", None, 0, False, "x"),
+        ("z", "p1", "u1", None, 0, False, "x"),
+        ("o", "p1", "u1", None, 0, False, "missing"),
+        ("q", "p1", "u1", None, 0, False, "o"),
+        ("s", "p1", "u1", None, 0, False, "s"),
+        ("t", "p2", "u2", None, 0, False, None),
+    ]
+    expected = {"c": 0, "a": 1, "b": 2, "x": 1, "y": 1, "z": 1, "o": 1, "q": 2, "s": 1, "t": 0}
+    assert depths(rows) == expected
+    # the same replies nested under their top-level comment, as the API returns them
+    thread = {"id": "c", "replies": [{"id": id_, "parent": parent} for id_, _, _, _, _, _, parent in rows[1:-1]]}
+    assert {item["id"]: depth for depth, item in iter_thread(thread)} == {id_: depth for id_, depth in expected.items() if id_ != "t"}
+    counts = engagement(rows).reply_depth_distribution().to_pydict()
+    assert counts == {"depth": [0, 1, 2], "comments": [2, 6, 2]}
+
+def test_post_statistics():
+    rows = [
+        ("c1", "p1", "u2", 1_700_000_000_000_000 + 600_000_000, 5, True, None),
+        ("c2", "p1", "u3", 1_700_000_000_000_000 + 5_400_000_000, 1, False, "c1"),
+        ("c3", "p1", "u2", 1_700_000_000_000_000 + 5_500_000_000, 2, False, None),
+        ("c4", "gone", "u3", None, 0, False, None),
+    ]
+    users = table("users", USER_COLUMNS, [("u2", "two"), ("u3", "three")])
+    result = engagement(rows, users)
+    assert result.comment_counts().tolist() == [3, 0]
+    posts = result.post_engagement().to_pydict()
+    assert posts["comments"] == [3, 0]
+    assert posts["engagement_rate"][0] == (10 + 2 + 1 + 3) / 1000
+    assert np.isnan(posts["engagement_rate"][1])
+    velocity = result.comment_velocity(bin_seconds=3600, horizon=3 * 3600).to_pydict()
+    assert velocity["comments"] == [1, 2, 0]
+    top = result.top_commenters(limit=1).to_pydict()
+    assert top == {"author": ["u2"], "comments": [2], "comment_likes": [7], "username": ["two"]}
+    ratio = result.liked_by_author_ratio().to_pydict()
+    assert ratio["liked_by_author"] == [1, 0] and ratio["ratio"][0] == 1 / 3
+
+def stats(conn):
+    # rows the triggers left at zero (every comment deleted) are absent after a rebuild
+    posts = conn.execute("SELECT * FROM post_stats WHERE (comments_count, replies_count, liked_by_author_count, comment_likes) <> (0, 0, 0, 0) ORDER BY post").fetchall()
+    commenters = conn.execute("SELECT * FROM commenter_stats WHERE (comments_count, comment_likes) <> (0, 0) ORDER BY author").fetchall()
+    return posts, commenters
+
+def test_trigger_aggregates_match_rebuild(postgres):
+    with psycopg.connect(postgres) as conn:
+        for query in SCHEMA:
+            conn.execute(query)
+        conn.execute("TRUNCATE posts, users, comments CASCADE")
+        conn.execute("INSERT INTO users (id, username) VALUES ('u1', 'one'), ('u2', 'two')")
+        conn.execute("INSERT INTO posts (id, author) VALUES ('p1', 'u1'), ('p2', 'u2')")
+        conn.commit()
+        create_aggregates(conn, rebuild=True)
+
+        def check():
+            conn.commit()
+            maintained = stats(conn)
+            create_aggregates(conn, rebuild=True)
+            assert stats(conn) == maintained
+            return maintained
+
+        conn.execute("""
+            INSERT INTO comments (id, post, author, likes_count, liked_by_author, parent) VALUES
+                ('c1', 'p1', 'u1', 3, true, NULL), ('c2', 'p1', 'u2', 4, false, 'c1'), ('c3', 'p2', 'u2', NULL, NULL, NULL)
+        """)
+        posts, commenters = check()
+        assert posts == [("p1", 2, 1, 1, 7), ("p2", 1, 0, 0, 0)]
+        assert commenters == [("u1", 1, 3), ("u2", 2, 4)]
+
+        conn.execute("UPDATE comments SET likes_count = 10, liked_by_author = true WHERE id = 'c2'")
+        assert check()[0][0] == ("p1", 2, 1, 2, 13)
+
+        conn.execute("UPDATE comments SET deleted = true WHERE id IN ('c1', 'c3')")
+        posts, commenters = check()
+        assert posts == [("p1", 1, 1, 1, 10)]
+        assert commenters == [("u2", 1, 10)]
+
+        # an upsert that brings a deleted comment back and adds a new one in one statement
+        conn.execute("""
+            INSERT INTO comments (id, post, author, likes_count, liked_by_author, parent) VALUES ('c1', 'p1', 'u1', 5, true, NULL), ('c4', 'p2', 'u1', 1, false, NULL)
+            ON CONFLICT (id) DO UPDATE SET likes_count = EXCLUDED.likes_count, deleted = false
+        """)
+        posts, commenters = check()
+        assert posts == [("p1", 2, 1, 2, 15), ("p2", 1, 0, 0, 1)]
+        assert commenters == [("u1", 2, 6), ("u2", 1, 10)]
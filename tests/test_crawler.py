@@ -0,0 +1,69 @@
+import json
+import asyncio
+from crawler import CreatorCrawler, DONE
+
+class FakeFeeds:
+    # two pages per creator, cursors 0 -> 10 -> end, with post "shared" on both creators' second page
+    def __init__(self):
+        self.started = []
+
+    async def iter_video_pages(self, sec_uid, cursor=0):
+        self.started.append((sec_uid, cursor))
+        pages = {0: ([{"id": f"{sec_uid}-1"}, {"id": f"{sec_uid}-2"}], 10), 10: ([{"id": "shared"}], None)}
+        while cursor in pages:
+            posts, cursor = pages[cursor]
+            yield posts, cursor
+            if cursor is None:
+                break
+
+def checkpoint(path):
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+def test_checkpoint_waits_for_commit(tmp_path):
+    path = tmp_path / "creators.json"
+
+    async def run():
+        crawler = CreatorCrawler(FakeFeeds(), path)
+        crawl = crawler.crawl(["a"])
+        # the first page is dequeued and handed on, then the run is interrupted before anything is committed
+        assert (await crawl.__anext__())["id"] == "a-1"
+        assert (await crawl.__anext__())["id"] == "a-2"
+        await crawl.aclose()
+        assert checkpoint(path) == {}
+
+        feeds = FakeFeeds()
+        crawler = CreatorCrawler(feeds, path)
+        crawler.load()
+        posts = []
+        async for post in crawler.crawl(["a"]):
+            posts.append(post["id"])
+            if post["id"] == "a-2":
+                crawler.done("a-1")
+                assert checkpoint(path) == {}
+                crawler.done("a-2")
+            if post["id"] == "shared":
+                assert checkpoint(path) == {"a": 10}
+        assert feeds.started == [("a", 0)]
+        assert posts == ["a-1", "a-2", "shared"]
+        assert checkpoint(path) == {"a": 10}
+        crawler.done("shared")
+        assert checkpoint(path) == {"a": DONE}
+    asyncio.run(run())
+
+def test_shared_post_holds_both_creators(tmp_path):
+    path = tmp_path / "creators.json"
+
+    async def run():
+        crawler = CreatorCrawler(FakeFeeds(), path)
+        posts = [post["id"] async for post in crawler.crawl(["a", "b"])]
+        assert sorted(posts) == ["a-1", "a-2", "b-1", "b-2", "shared"]
+        for post_id in ["a-1", "a-2", "b-1", "b-2"]:
+            crawler.done(post_id)
+        assert checkpoint(path) == {"a": 10, "b": 10}
+        crawler.done("shared")
+        assert checkpoint(path) == {"a": DONE, "b": DONE}
+    asyncio.run(run())
@@ -0,0 +1,17 @@
+from db import WriteBuffer
+
+def test_write_buffer_due_on_rows():
+    buffer = WriteBuffer(flush_size=5, flush_interval=3600)
+    assert not buffer.due()
+    buffer.add(["u1"], {"id": "p1"}, ["c1"])
+    assert buffer.rows == 3 and not buffer.due()
+    buffer.add(["u2"], {"id": "p2"}, [])
+    assert buffer.due()
+    assert [post["id"] for _, post, _ in buffer.take()] == ["p1", "p2"]
+    assert buffer.rows == 0 and buffer.batch == [] and not buffer.due()
+
+def test_write_buffer_due_on_interval():
+    buffer = WriteBuffer(flush_size=1000, flush_interval=0)
+    assert not buffer.due()
+    buffer.add([], {"id": "p1"}, [])
+    assert buffer.due()
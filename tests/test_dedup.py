@@ -0,0 +1,37 @@
+import asyncio
+from async_db import open_pool
+from dedup import ProcessedFilter
+
+async def insert_posts(pool, ids):
+    async with pool.connection() as conn:
+        for id_ in ids:
+            await conn.execute("INSERT INTO posts (id, title, author, scraped) VALUES (%s, '', 'u1', now())", (id_,))
+
+def test_filter_catches_up_on_writes_since_save(postgres, tmp_path):
+    path = str(tmp_path / "processed.bloom")
+
+    async def run():
+        async with await open_pool(conninfo=postgres) as pool:
+            async with pool.connection() as conn:
+                await conn.execute("TRUNCATE posts CASCADE")
+            await insert_posts(pool, ["p1"])
+            processed = ProcessedFilter(pool, path)
+            await processed.load()
+            assert await processed.unseen(["p1", "p2"]) == ["p2"]
+            processed.save()
+
+            # another process writes p2, and this one writes p3 but is killed before saving its filter
+            await insert_posts(pool, ["p2", "p3"])
+            processed.add("p3")
+
+            processed = ProcessedFilter(pool, path)
+            await processed.load()
+            assert "p2" in processed.bloom and "p3" in processed.bloom
+            assert await processed.unseen(["p1", "p2", "p3", "p4"]) == ["p4"]
+
+            # writes after load are picked up once sync_interval has passed
+            processed.sync_interval = 0
+            await insert_posts(pool, ["p4"])
+            assert await processed.unseen(["p4", "p5"]) == ["p5"]
+            assert "p4" in processed.bloom
+    asyncio.run(run())
@@ -0,0 +1,81 @@
+import importlib
+import config
+from detection import FuzzyIndex, KeywordMatcher, bounded_edit_distance, detect_relevant_content
+
+def matches(keyword, text, threshold):
+    return FuzzyIndex([(0, keyword)], threshold).search(text) == {0: text}
+
+def test_exact_threshold_one_edit():
+    # 1 - 1/5 is exactly 0.8
+    assert matches("hello", "hallo", 0.8)
+    assert not matches("hello", "hxllx", 0.8)
+
+def test_exact_threshold_two_edits():
+    # 1 - 2/10 is exactly 0.8
+    assert matches("keyboards1", "kayboardz1", 0.8)
+    assert not matches("keyboards1", "kayboardzz", 0.8)
+
+def test_exact_threshold_other_ratios():
+    assert matches("abcdefghij", "abcdefgxyz", 0.7)
+    assert not matches("abcdefghij", "abcdefwxyz", 0.7)
+    assert matches("abc", "abc", 1.0)
+    assert not matches("abc", "abd", 1.0)
+
+def test_bounded_edit_distance():
+    assert bounded_edit_distance("kitten", "sitting", 3) == 3
+    assert bounded_edit_distance("kitten", "sitting", 2) == 3
+
+def test_keyword_exact_match():
+    matcher = KeywordMatcher(["cat", "Dog", "free shipping", "cat"])
+    # case-insensitive, reported as written in the text, in keyword order, once per keyword
+    assert matcher.match("DOG and my Cat, cat. FREE SHIPPING!") == ["Cat", "DOG", "FREE SHIPPING", "Cat"]
+    assert matcher.match("nothing here") == []
+
+def test_keyword_word_boundary():
+    matcher = KeywordMatcher(["cat", "e-mail", "new york"])
+    assert matcher.match("category concatenate") == []
+    assert matcher.match("the cat's toy") == ["cat"]
+    assert matcher.match("send an e-mail") == ["e-mail"]
+    assert matcher.match("e-mails") == []
+    # phrases match anywhere, like the per-comment scan did
+    assert matcher.match("renew yorkshire") == ["new york"]
+
+def test_keyword_exclude_list():
+    matcher = KeywordMatcher(["sale", "apple"], ["SALE", "pear"])
+    assert matcher.match("Sale on apples") == []
+    assert matcher.match("sale on apple pear") == ["apple"]
+    assert matcher.match("apple") == ["apple"]
+
+def test_keyword_overlap():
+    matcher = KeywordMatcher(["new york", "york", "apple"], ["apple pie", "new"])
+    # an excluded match only removes include matches of exactly the same text
+    assert matcher.match("New York apple pie") == ["New York", "York", "apple"]
+    for text in ["New York apple pie", "renew yorkshire", "york york", "an apple pie"]:
+        assert matcher.match(text) == detect_relevant_content(text, ["new york", "york", "apple"], ["apple pie", "new"])
+
+def test_fuzzy_keyword_match():
+    matcher = KeywordMatcher(["giveaway", "sale", "free shipping"], ["scam"], fuzzy_threshold=0.8)
+    assert matcher.match("huge g1veaway, $ale and FREE SHIPPING") == ["g1veaway", "$ale", "FREE SHIPPING"]
+    assert matcher.match("giveaway sc4m") == ["giveaway"]
+    # the exclude list only drops include matches of the same text, fuzzy ones included
+    assert matcher.match("this giveawey is a sc@m") == ["giveawey"]
+    assert KeywordMatcher(["sale"], ["sale"], fuzzy_threshold=0.8).match("$ale") == []
+
+def test_fuzzy_tokens_split_once():
+    exact = KeywordMatcher(["x"])
+    fuzzy = KeywordMatcher(["x"], fuzzy_threshold=0.8)
+    for text in ["a@b c$d+e a@b", "Hello, hello WORLD w0rld!", "", "e-mail @@ $ +x+ x"]:
+        words, fuzzy_tokens = fuzzy.tokenize(text)
+        # the word tokens cut from the fuzzy tokens are the plain \w+ split, order included
+        assert list(words.items()) == list(exact.tokenize(text)[0].items())
+        assert fuzzy_tokens == FuzzyIndex.tokenize(text)
+
+def test_fuzzy_match_setting(monkeypatch):
+    try:
+        monkeypatch.setenv("FUZZY_MATCH", "0.8")
+        assert importlib.reload(config).FUZZY_MATCH == 0.8
+        monkeypatch.setenv("FUZZY_MATCH", "")
+        assert importlib.reload(config).FUZZY_MATCH is None
+    finally:
+        monkeypatch.undo()
+        importlib.reload(config)
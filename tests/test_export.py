@@ -0,0 +1,73 @@
+import pytest
+import psycopg
+import pyarrow as pa
+from db import SCHEMA
+from export import export_all, open_export, load_state, read_table, SCHEMAS
+from analytics import Engagement
+
+@pytest.fixture
+def conn(postgres):
+    conn = psycopg.connect(postgres)
+    for query in SCHEMA:
+        conn.execute(query)
+    conn.execute("TRUNCATE posts, users, comments CASCADE")
+    conn.execute("INSERT INTO users (id, username, scraped) VALUES ('u1', 'user1', now()), ('u2', '', now())")
+    conn.execute("INSERT INTO posts (id, author, title, likes_count, created, scraped) VALUES ('p1', 'u1', 'a, \"quoted\"\ntitle', 10, '2024-01-01 10:00', now()), ('p2', 'u2', NULL, 20, '2024-01-02 10:00', now())")
+    conn.execute("""
+        INSERT INTO comments (id, post, author, created, text, likes_count, liked_by_author, parent, scraped) VALUES
+            ('c0', 'p1', 'u2', '2024-01-01 11:00', 'from before scraped was recorded', 0, NULL, NULL, NULL),
+            ('c1', 'p1', 'u2', '2024-01-01 12:00', '', 1, true, NULL, now()),
+            ('c2', 'p1', 'u1', '2024-01-01 13:00', 'gone soon', 2, false, NULL, now()),
+            ('c3', 'p2', 'u1', '2024-01-02 12:00', 'reply', 3, false, 'c1', now())
+    """)
+    conn.commit()
+    yield conn
+    conn.close()
+
+def rows(path, table):
+    return sorted(open_export(path, table).to_table().to_pylist(), key=lambda row: (row["id"], row["scraped"] or 0))
+
+def test_copy_to_arrow_types_and_values(conn):
+    table = read_table(conn, "SELECT id, username FROM users ORDER BY id", (), pa.schema([("id", pa.string()), ("username", pa.string())]))
+    # an empty string stays empty, only a bare empty field is NULL
+    assert table.to_pylist() == [{"id": "u1", "username": "user1"}, {"id": "u2", "username": ""}]
+    assert read_table(conn, "SELECT id FROM users WHERE false", (), pa.schema([("id", pa.string())])).num_rows == 0
+
+def test_incremental_export_and_latest_rows(conn, tmp_path):
+    path = str(tmp_path / "export")
+    assert export_all(conn, path, "parquet", "date", settle=0) == {"users": 2, "posts": 2, "comments": 4}
+    state = load_state(path)
+    assert (state["format"], state["partition"]) == ("parquet", "date")
+    assert set(state) >= set(SCHEMAS)
+
+    posts = rows(path, "posts")
+    assert posts[0]["title"] == 'a, "quoted"\ntitle' and posts[1]["title"] is None
+    comments = rows(path, "comments")
+    assert [row["id"] for row in comments] == ["c0", "c1", "c2", "c3"]
+    assert comments[1]["text"] == "" and comments[1]["liked_by_author"] is True and comments[0]["liked_by_author"] is None
+    assert str(comments[3]["date"]) == "2024-01-02"
+
+    # a refresh re-stamps c1 with new likes and soft-deletes c2; only those rows go out with the next export
+    conn.execute("UPDATE comments SET likes_count = 9, scraped = now() WHERE id = 'c1'")
+    conn.execute("UPDATE comments SET deleted = true, scraped = now() WHERE id = 'c2'")
+    conn.commit()
+    assert export_all(conn, path, "parquet", "date", settle=0) == {"users": 0, "posts": 0, "comments": 2}
+    assert len(rows(path, "comments")) == 6
+
+    engagement = Engagement.from_export(path)
+    latest = sorted(engagement.comments.to_pylist(), key=lambda row: row["id"])
+    assert [(row["id"], row["likes_count"]) for row in latest] == [("c0", 0), ("c1", 9), ("c3", 3)]
+    assert dict(zip(engagement.post_ids.to_pylist(), engagement.comment_counts().tolist())) == {"p1": 2, "p2": 1}
+
+def test_format_and_partition_mismatch(conn, tmp_path):
+    path = str(tmp_path / "export")
+    export_all(conn, path, "parquet", "date", settle=0)
+    with pytest.raises(ValueError):
+        export_all(conn, path, "arrow", "date", settle=0)
+    with pytest.raises(ValueError):
+        export_all(conn, path, "parquet", "post", settle=0)
+
+    other = str(tmp_path / "by_post")
+    assert export_all(conn, other, "arrow", "post", full=True, settle=0)["comments"] == 4
+    comments = rows(other, "comments")
+    assert [row["post_id"] for row in comments] == ["p1", "p1", "p1", "p2"]
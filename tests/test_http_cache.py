@@ -0,0 +1,42 @@
+import os
+import asyncio
+import pytest
+from http_cache import HTTPCache, CacheMiss
+
+def size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, files in os.walk(path) for name in files if name.endswith(".json.z"))
+
+def test_record_then_replay(tmp_path):
+    calls = []
+
+    async def fetch(body):
+        calls.append(body)
+        return body
+
+    async def run():
+        record = HTTPCache(tmp_path, "record")
+        assert await record.get_json(lambda: fetch({"comments": [1]}), "https://example.com/a", {"cursor": 0, "X-Bogus": "1"}) == {"comments": [1]}
+        # a cached null body is an entry like any other
+        assert await record.get_json(lambda: fetch(None), "https://example.com/null") is None
+        replay = HTTPCache(tmp_path, "replay")
+        assert await replay.get_json(lambda: fetch("unused"), "https://example.com/a", {"cursor": 0, "X-Bogus": "2"}) == {"comments": [1]}
+        assert await replay.get_json(lambda: fetch("unused"), "https://example.com/null") is None
+        with pytest.raises(CacheMiss):
+            await replay.get_json(lambda: fetch("unused"), "https://example.com/b")
+        assert calls == [{"comments": [1]}, None]
+    asyncio.run(run())
+
+def test_running_size_and_eviction(tmp_path):
+    cache = HTTPCache(tmp_path, "record", max_bytes=4000)
+    os.makedirs(tmp_path / "ab")
+    # an entry left by an earlier run is counted by the first store
+    (tmp_path / "ab" / "old.json.z").write_bytes(b"x" * 500)
+    cache.store("https://example.com/0", None, {"n": 0})
+    assert cache.total_bytes == size(tmp_path)
+    # overwriting an entry replaces its size rather than adding to it
+    cache.store("https://example.com/0", None, {"n": "0" * 200})
+    assert cache.total_bytes == size(tmp_path)
+    for i in range(1, 100):
+        cache.store(f"https://example.com/{i}", None, {"n": i, "pad": os.urandom(50).hex()})
+        assert cache.total_bytes == size(tmp_path) <= 4000
+    assert not (tmp_path / "ab" / "old.json.z").exists()
@@ -0,0 +1,26 @@
+import asyncio
+from normalize import CommentNormalizer
+from main import fetch_worker
+
+class FakeTikTok:
+    async def get_normalized_comments(self, post_id):
+        return CommentNormalizer(post_id)
+
+def test_fetch_worker_uploads_before_handing_post_on():
+    async def run():
+        uploaded = []
+
+        async def upload(post, users):
+            if post["id"] == "broken":
+                raise ConnectionError("upload failed")
+            uploaded.append(post["id"])
+
+        inbox, queue = asyncio.Queue(), asyncio.Queue()
+        for post in ({"id": "p1"}, {"id": "broken"}, {"id": "p2"}, None):
+            inbox.put_nowait(post)
+        await fetch_worker(FakeTikTok(), inbox, queue, upload=upload)
+        queued = [queue.get_nowait()[0]["id"] for _ in range(queue.qsize())]
+        # a post whose media failed to upload is not written, like one whose comments failed to fetch
+        assert uploaded == ["p1", "p2"]
+        assert queued == ["p1", "p2"]
+    asyncio.run(run())
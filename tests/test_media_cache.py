@@ -0,0 +1,94 @@
+import asyncio
+import hashlib
+import pytest
+import aiohttp
+from aiohttp import web
+from ratelimit import RateLimiter
+
+IMAGES = {"a": b"image a" * 100, "a-copy": b"image a" * 100, "b": b"image b" * 100}
+
+async def serve_images(requests):
+    # each image carries the md5 of its bytes as ETag and answers If-None-Match with 304
+    async def image(request):
+        name = request.match_info["name"]
+        requests.append(name)
+        etag = f'"{hashlib.md5(IMAGES[name]).hexdigest()}"'
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers={"ETag": etag})
+        return web.Response(body=IMAGES[name], headers={"ETag": etag}, content_type="image/jpeg")
+
+    app = web.Application()
+    app.router.add_get("/img/{name}", image)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return runner, f"http://127.0.0.1:{runner.addresses[0][1]}"
+
+def test_media_cache_dedup(postgres, s3_endpoint):
+    aioboto3 = pytest.importorskip("aioboto3")
+    from async_db import open_pool
+    from media_cache import MediaCache
+
+    async def run():
+        requests = []
+        runner, base_url = await serve_images(requests)
+        try:
+            async with await open_pool(conninfo=postgres) as pool, aiohttp.ClientSession() as session:
+                async with pool.connection() as conn:
+                    await conn.execute("TRUNCATE media")
+                async with aioboto3.Session().client("s3", endpoint_url=s3_endpoint, aws_access_key_id="test", aws_secret_access_key="test", region_name="us-east-1") as s3:
+                    await s3.create_bucket(Bucket="media")
+                    put_calls, copy_calls = [], []
+                    put_object, copy_object = s3.put_object, s3.copy_object
+
+                    async def put(**kwargs):
+                        put_calls.append(kwargs["Key"])
+                        return await put_object(**kwargs)
+
+                    async def copy(**kwargs):
+                        copy_calls.append((kwargs["CopySource"]["Key"], kwargs["Key"]))
+                        return await copy_object(**kwargs)
+
+                    s3.put_object, s3.copy_object = put, copy
+
+                    async def body(key):
+                        response = await s3.get_object(Bucket="media", Key=key)
+                        async with response["Body"] as stream:
+                            return await stream.read()
+
+                    cache = MediaCache(pool, "media", limiter=RateLimiter())
+                    assert await cache.upload(s3, session, "avatar/u1", f"{base_url}/img/a?x-signature=1", "image/jpeg")
+                    assert put_calls == ["avatar/u1"] and requests == ["a"]
+
+                    # the same image under a new signature is answered from the in-memory LRU without a request
+                    assert not await cache.upload(s3, session, "avatar/u1", f"{base_url}/img/a?x-signature=2", "image/jpeg")
+                    assert requests == ["a"]
+
+                    # a fresh process finds the key and source in the media table
+                    cache = MediaCache(pool, "media", limiter=RateLimiter())
+                    assert not await cache.upload(s3, session, "avatar/u1", f"{base_url}/img/a?x-signature=3", "image/jpeg")
+                    assert requests == ["a"]
+
+                    # identical bytes under another key are copied server-side instead of uploaded again
+                    assert not await cache.upload(s3, session, "avatar/u2", f"{base_url}/img/a-copy", "image/jpeg")
+                    assert copy_calls == [("avatar/u1", "avatar/u2")] and put_calls == ["avatar/u1"]
+                    assert await body("avatar/u2") == IMAGES["a"]
+
+                    # a new source url whose ETag still matches is revalidated with a 304 and nothing is sent
+                    async with pool.connection() as conn:
+                        await conn.execute("UPDATE media SET source_url = 'http://elsewhere/a', source_etag = %s WHERE key = 'avatar/u1'", (f'"{hashlib.md5(IMAGES["a"]).hexdigest()}"',))
+                    cache = MediaCache(pool, "media", limiter=RateLimiter())
+                    assert not await cache.upload(s3, session, "avatar/u1", f"{base_url}/img/a", "image/jpeg")
+                    assert put_calls == ["avatar/u1"] and len(copy_calls) == 1
+
+                    # changed content for a key is uploaded
+                    assert await cache.upload(s3, session, "avatar/u1", f"{base_url}/img/b", "image/jpeg")
+                    assert put_calls == ["avatar/u1", "avatar/u1"]
+                    assert await body("avatar/u1") == IMAGES["b"]
+                    async with pool.connection() as conn:
+                        cur = await conn.execute("SELECT key, content_md5 FROM media ORDER BY key")
+                        assert await cur.fetchall() == [("avatar/u1", hashlib.md5(IMAGES["b"]).hexdigest()), ("avatar/u2", hashlib.md5(IMAGES["a"]).hexdigest())]
+        finally:
+            await runner.cleanup()
+    asyncio.run(run())
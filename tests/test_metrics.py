@@ -0,0 +1,14 @@
+from metrics import Metrics, escape_label
+
+def test_escape_label():
+    assert escape_label('a\\b"c\nd') == 'a\\\\b\\"c\\nd'
+    assert escape_label(429) == "429"
+
+def test_prometheus_escapes_label_values():
+    metrics = Metrics(enabled=True)
+    metrics.inc("errors_total", reason='bad "quote"\\path\nline')
+    metrics.observe("latency_seconds", 0.2, host="a\"b")
+    text = metrics.prometheus()
+    assert 'errors_total{reason="bad \\"quote\\"\\\\path\\nline"} 1' in text
+    assert 'latency_seconds_count{host="a\\"b"} 1' in text
+    assert 'latency_seconds_bucket{host="a\\"b",le="0.25"} 1' in text
@@ -0,0 +1,65 @@
+import asyncio
+from ratelimit import HostLimiter, RateLimiter
+
+def test_cancelled_acquire_releases_slot():
+    async def run():
+        host = HostLimiter(0.01, 1, 2)
+        await host.acquire()
+        waiter = asyncio.create_task(host.acquire())
+        await asyncio.sleep(0.05)
+        assert host.in_flight == 2
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert host.in_flight == 1
+        await host.release()
+        assert host.in_flight == 0
+    asyncio.run(run())
+
+def test_cancelled_request_does_not_stall_host():
+    async def run():
+        limiter = RateLimiter(host_limits={"example.com": (0.01, 1, 1)})
+        host = limiter.host("https://example.com/a")
+        await host.bucket.acquire()
+
+        async def request():
+            async with limiter.get(None, "https://example.com/a"):
+                pass
+
+        task = asyncio.create_task(request())
+        await asyncio.sleep(0.05)
+        assert host.in_flight == 1
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        assert host.in_flight == 0
+        # the slot is free again, so the next request is only held up by the token bucket
+        host.bucket.tokens = 1
+        await asyncio.wait_for(host.acquire(), 1)
+        assert host.in_flight == 1
+    asyncio.run(run())
+
+class FakeResponse:
+    status = 200
+    headers = {}
+
+    def raise_for_status(self):
+        pass
+
+    def release(self):
+        pass
+
+class FakeSession:
+    async def get(self, url, **kwargs):
+        return FakeResponse()
+
+def test_slow_body_does_not_count_as_latency():
+    async def run():
+        limiter = RateLimiter(host_limits={"example.com": (1000, 1000, 4)})
+        host = limiter.host("https://example.com/video.mp4")
+        host.latency_target = 0.05
+        for _ in range(3):
+            async with limiter.get(FakeSession(), "https://example.com/video.mp4"):
+                # a long download once the headers are in
+                await asyncio.sleep(0.1)
+        assert host.concurrency == 4
+        assert host.in_flight == 0
+    asyncio.run(run())
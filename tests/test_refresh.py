@@ -0,0 +1,101 @@
+import asyncio
+from async_db import open_pool
+from benchmarks.stubs import user
+from refresh import reply_counts, write_refresh
+from tiktok import TikTok
+
+def raw_comment(cid, replies=0, likes=0, liked=False):
+    return {"cid": cid, "user": user(1, "http://stub"), "create_time": 1700000000, "digg_count": likes, "text": cid, "is_author_digged": liked, "reply_comment_total": replies}
+
+def raw_reply(cid, parent):
+    return {"cid": cid, "user": user(2, "http://stub"), "create_time": 1700000100, "digg_count": 0, "text": cid, "is_author_digged": False, "reply_id": parent}
+
+class FakeTikTok(TikTok):
+    # comment and reply pages served from dicts keyed by cursor, a missing cursor answers with an error body
+    def __init__(self, comment_pages, reply_pages=None):
+        super().__init__(None)
+        self.comment_pages = comment_pages
+        self.reply_pages = reply_pages or {}
+
+    async def _TikTok__get_comment(self, post_id, count, cursor):
+        return self.comment_pages.get(cursor, {"status_code": 10201})
+
+    async def _TikTok__get_replies(self, post_id, comment_id, count, cursor=0):
+        return self.reply_pages.get((comment_id, cursor), {"status_code": 10201})
+
+def listing(known_replies=None, **kwargs):
+    return asyncio.run(FakeTikTok(**kwargs).get_normalized_comments("p1", known_replies=known_replies))
+
+def test_complete_listing():
+    normalizer = listing(
+        comment_pages={0: {"comments": [raw_comment("c1", 1)], "has_more": 1, "cursor": 50}, 50: {"comments": [raw_comment("c2")], "has_more": 0}},
+        reply_pages={("c1", 0): {"comments": [raw_reply("r1", "c1")], "has_more": 0}})
+    assert normalizer.complete
+    assert [record.id for record in normalizer.comments] == ["c1", "c2", "r1"]
+
+def test_comment_listing_cut_short():
+    normalizer = listing(comment_pages={0: {"comments": [raw_comment("c1")], "has_more": 1, "cursor": 50}})
+    assert not normalizer.complete
+    assert [record.id for record in normalizer.comments] == ["c1"]
+
+def test_reply_listing_cut_short():
+    normalizer = listing(
+        comment_pages={0: {"comments": [raw_comment("c1", 2)], "has_more": 0}},
+        reply_pages={("c1", 0): {"comments": [raw_reply("r1", "c1")], "has_more": 1, "cursor": 50}})
+    assert not normalizer.complete
+    assert [record.id for record in normalizer.comments] == ["c1", "r1"]
+
+def test_incomplete_listing_deletes_nothing(postgres):
+    async def run():
+        async with await open_pool(conninfo=postgres) as pool:
+            async with pool.connection() as conn:
+                await conn.execute("TRUNCATE posts, users, comments CASCADE")
+                await conn.execute("INSERT INTO users (id, username) VALUES ('u1', 'user1')")
+                await conn.execute("INSERT INTO posts (id, author) VALUES ('p1', 'u1')")
+                for cid in ("c1", "c2"):
+                    await conn.execute("INSERT INTO comments (id, post, author) VALUES (%s, 'p1', 'u1')", (cid,))
+
+            async def deleted():
+                async with pool.connection() as conn:
+                    cur = await conn.execute("SELECT id FROM comments WHERE deleted ORDER BY id")
+                    return [row[0] for row in await cur.fetchall()]
+
+            known = await reply_counts(pool, "p1")
+            # the second page fails, so c2 was never seen but may well still exist
+            partial = await FakeTikTok({0: {"comments": [raw_comment("c1")], "has_more": 1, "cursor": 50}}).get_normalized_comments("p1", known_replies=known)
+            assert (await write_refresh(pool, "p1", partial, known))[1] == 0
+            assert await deleted() == []
+
+            full = await FakeTikTok({0: {"comments": [raw_comment("c1")], "has_more": 0}}).get_normalized_comments("p1", known_replies=known)
+            assert (await write_refresh(pool, "p1", full, known))[1] == 1
+            assert await deleted() == ["c2"]
+    asyncio.run(run())
+
+def test_deleted_comment_comes_back(postgres):
+    async def run():
+        async with await open_pool(conninfo=postgres) as pool:
+            async with pool.connection() as conn:
+                await conn.execute("TRUNCATE posts, users, comments CASCADE")
+                await conn.execute("INSERT INTO users (id, username) VALUES ('u1', 'user1')")
+                await conn.execute("INSERT INTO posts (id, author) VALUES ('p1', 'u1')")
+                for cid in ("c1", "c2"):
+                    await conn.execute("INSERT INTO comments (id, post, author, likes_count, liked_by_author) VALUES (%s, 'p1', 'u1', 5, false)", (cid,))
+
+            async def stored():
+                async with pool.connection() as conn:
+                    cur = await conn.execute("SELECT id, likes_count, liked_by_author, coalesce(deleted, false) FROM comments ORDER BY id")
+                    return await cur.fetchall()
+
+            async def refresh(comments):
+                known = await reply_counts(pool, "p1")
+                normalizer = await FakeTikTok({0: {"comments": comments, "has_more": 0}}).get_normalized_comments("p1", known_replies=known)
+                return await write_refresh(pool, "p1", normalizer, known)
+
+            # unchanged comments are not rewritten
+            assert await refresh([raw_comment("c1", likes=5), raw_comment("c2", likes=5)]) == (0, 0)
+            assert await refresh([raw_comment("c1", likes=5)]) == (0, 1)
+            assert await stored() == [("c1", 5, False, False), ("c2", 5, False, True)]
+            # c2 is back with the same like count, and only c1's liked_by_author changed
+            assert await refresh([raw_comment("c1", likes=5, liked=True), raw_comment("c2", likes=5)]) == (2, 0)
+            assert await stored() == [("c1", 5, True, False), ("c2", 5, False, False)]
+    asyncio.run(run())
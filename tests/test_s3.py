@@ -0,0 +1,125 @@
+import asyncio
+import pytest
+from s3 import merge, delete_objects, reconcile, stream_upload
+
+class FailingS3:
+    # accepts the upload, then fails every part
+    def __init__(self):
+        self.aborted = False
+
+    async def create_multipart_upload(self, **kwargs):
+        return {"UploadId": "upload"}
+
+    async def upload_part(self, **kwargs):
+        raise ConnectionError("part failed")
+
+    async def abort_multipart_upload(self, **kwargs):
+        self.aborted = True
+
+def test_failed_upload_closes_chunks():
+    closed = []
+
+    async def chunks():
+        try:
+            for _ in range(100):
+                yield b"x" * 4
+        finally:
+            closed.append(True)
+
+    async def run():
+        s3 = FailingS3()
+        with pytest.raises(ConnectionError):
+            await stream_upload(s3, "bucket", "key", chunks(), "video/mp4", part_size=4, max_pending=1)
+        assert s3.aborted
+        assert closed == [True]
+    asyncio.run(run())
+
+def test_merge_yields_every_item():
+    async def numbers(start, count, delay):
+        for i in range(start, start + count):
+            await asyncio.sleep(delay)
+            yield i
+
+    async def run():
+        return [item async for item in merge([numbers(0, 5, 0.002), numbers(100, 3, 0.001), numbers(200, 0, 0)], queue_size=2)]
+    items = asyncio.run(run())
+    assert sorted(items) == [0, 1, 2, 3, 4, 100, 101, 102]
+
+def test_merge_raises_first_error():
+    async def fails():
+        yield 1
+        raise KeyError("listing failed")
+
+    async def forever():
+        while True:
+            await asyncio.sleep(0.01)
+            yield 0
+
+    async def run():
+        async for _ in merge([fails(), forever()]):
+            pass
+    with pytest.raises(KeyError):
+        asyncio.run(run())
+
+class RecordingS3:
+    # reports the keys in refuse as per-key errors and fails whole batches that contain a key in broken
+    def __init__(self, refuse=(), broken=()):
+        self.batches = []
+        self.refuse = set(refuse)
+        self.broken = set(broken)
+
+    async def delete_objects(self, Bucket, Delete):
+        keys = [item["Key"] for item in Delete["Objects"]]
+        self.batches.append(keys)
+        await asyncio.sleep(0)
+        if self.broken & set(keys):
+            raise ConnectionError("batch failed")
+        return {"Errors": [{"Key": key, "Code": "AccessDenied", "Message": "denied"} for key in keys if key in self.refuse]}
+
+def test_delete_objects_batches_and_collects_errors():
+    keys = [f"video/{i}" for i in range(25)]
+
+    async def keys_async():
+        for key in keys:
+            yield key
+
+    async def run(source):
+        s3 = RecordingS3(refuse=["video/3", "video/12"], broken=["video/21"])
+        deleted, errors = await delete_objects(s3, "bucket", source, concurrency=2, batch_size=10)
+        return s3, deleted, errors
+
+    for source in (keys, keys_async()):
+        s3, deleted, errors = asyncio.run(run(source))
+        assert [len(batch) for batch in s3.batches] == [10, 10, 5]
+        assert sorted(key for batch in s3.batches for key in batch) == sorted(keys)
+        # two refused keys plus the whole failed batch of five
+        assert deleted == 25 - 2 - 5
+        assert sorted(error["Key"] for error in errors) == sorted(["video/3", "video/12"] + keys[20:])
+        assert {error["Code"] for error in errors} == {"AccessDenied", "ConnectionError"}
+
+def test_reconcile_merge_join(postgres, s3_endpoint):
+    aioboto3 = pytest.importorskip("aioboto3")
+    from async_db import open_pool
+    # ids whose bytewise order differs from a natural-language collation
+    posts = ["B", "a", "_x", "a-b", "aB"]
+
+    async def run():
+        async with await open_pool(conninfo=postgres) as pool:
+            async with pool.connection() as conn:
+                await conn.execute("TRUNCATE posts, users, comments CASCADE")
+                await conn.execute("INSERT INTO users (id, username) VALUES ('u1', 'user1')")
+                for id_ in posts:
+                    await conn.execute("INSERT INTO posts (id, author) VALUES (%s, 'u1')", (id_,))
+            async with aioboto3.Session().client("s3", endpoint_url=s3_endpoint, aws_access_key_id="test", aws_secret_access_key="test", region_name="us-east-1") as s3:
+                await s3.create_bucket(Bucket="reconcile")
+                stored = [f"video/{id_}" for id_ in posts if id_ != "a"] + ["video/zz", "video/A"] + [f"thumbnail/{id_}" for id_ in posts] + ["avatar/u9"]
+                for key in stored:
+                    await s3.put_object(Bucket="reconcile", Key=key, Body=b"x")
+
+                # everything was just uploaded, so nothing is old enough to be an orphan yet
+                recent = sorted([item async for item in reconcile(s3, pool, "reconcile")])
+                assert recent == [("missing", "avatar/u1"), ("missing", "video/a")]
+
+                found = sorted([item async for item in reconcile(s3, pool, "reconcile", grace=-60)])
+                assert found == [("missing", "avatar/u1"), ("missing", "video/a"), ("orphan", "avatar/u9"), ("orphan", "video/A"), ("orphan", "video/zz")]
+    asyncio.run(run())
@@ -0,0 +1,65 @@
+import json
+import pytest
+from utils import iter_json_items, reply_children, threaded_comments_and_replies, iter_thread
+
+def items(tmp_path, text, chunk_size=4):
+    path = tmp_path / "items.json"
+    path.write_text(text)
+    return list(iter_json_items(path, chunk_size))
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 1 << 16])
+def test_array(tmp_path, chunk_size):
+    data = [{"id": "1", "title": "a, b ]"}, 12345, [1, [2]], "x", None]
+    assert items(tmp_path, json.dumps(data, indent=2), chunk_size) == data
+    assert items(tmp_path, " [ ] ", chunk_size) == []
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 1 << 16])
+def test_json_lines(tmp_path, chunk_size):
+    assert items(tmp_path, '{"id": 1}\n{"id": 22}\n\n3\n', chunk_size) == [{"id": 1}, {"id": 22}, 3]
+    assert items(tmp_path, "", chunk_size) == []
+
+@pytest.mark.parametrize("text", ["[1, 2", "[1, 2,", "[", "[1,,2]", "[,1]", "[1,]", "[1 2]"])
+@pytest.mark.parametrize("chunk_size", [1, 3, 1 << 16])
+def test_malformed_array(tmp_path, text, chunk_size):
+    with pytest.raises(ValueError):
+        items(tmp_path, text, chunk_size)
+
+def reply(id_, parent):
+    return {"id": id_, "parent": parent}
+
+def nested(comment):
+    # (depth, id) pairs of a threaded comment in depth-first order, walked without recursion
+    stack = [(0, comment)]
+    while stack:
+        depth, item = stack.pop()
+        yield depth, item["id"]
+        for child in reversed(item.get("replies", [])):
+            stack.append((depth + 1, child))
+
+def check(comment, depths):
+    # both the threaded form and iter_thread hold every distinct reply exactly once, at the expected depth
+    walked = [(depth, item["id"]) for depth, item in iter_thread(comment)]
+    assert sorted(id_ for _, id_ in walked) == sorted(depths)
+    assert dict((id_, depth) for depth, id_ in walked) == depths
+    children = reply_children(comment)
+    assert sorted(reply["id"] for replies in children.values() for reply in replies) == sorted(depths.keys() - {comment["id"]})
+    assert list(nested(threaded_comments_and_replies([comment])[0])) == walked
+
+def test_deep_chain():
+    # deeper than the recursion limit
+    replies = [reply(f"r{i}", f"r{i - 1}" if i else "c") for i in range(5000)]
+    check({"id": "c", "replies": replies}, {"c": 0, **{f"r{i}": i + 1 for i in range(5000)}})
+
+def test_duplicate_reply_ids():
+    comment = {"id": "c", "replies": [reply("a", "c"), reply("b", "a"), reply("a", "c"), reply("b", "a")]}
+    check(comment, {"c": 0, "a": 1, "b": 2})
+
+def test_missing_parent():
+    comment = {"id": "c", "replies": [reply("a", "c"), reply("o", "gone"), reply("p", "o"), reply("n", None)]}
+    check(comment, {"c": 0, "a": 1, "o": 1, "p": 2, "n": 1})
+
+def test_parent_cycle():
+    comment = {"id": "c", "replies": [reply("a", "c"), reply("x", "y"), reply("y", "x"), reply("z", "x"), reply("s", "s")]}
+    check(comment, {"c": 0, "a": 1, "x": 1, "y": 1, "z": 1, "s": 1})
+    # the order of the API listing is kept among siblings
+    assert [item["id"] for _, item in iter_thread(comment)] == ["c", "a", "x", "y", "z", "s"]
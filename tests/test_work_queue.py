@@ -0,0 +1,122 @@
+import asyncio
+from async_db import open_pool
+from work_queue import WorkQueue
+
+def run_with_queue(postgres, test):
+    async def run():
+        async with await open_pool(conninfo=postgres) as pool:
+            await WorkQueue(pool).create()
+            async with pool.connection() as conn:
+                await conn.execute("TRUNCATE post_queue")
+                await conn.execute("TRUNCATE posts, users, comments CASCADE")
+            await test(pool)
+    asyncio.run(run())
+
+async def rows(pool):
+    async with pool.connection() as conn:
+        cur = await conn.execute("SELECT id, status, worker, attempts FROM post_queue ORDER BY id")
+        return await cur.fetchall()
+
+def posts(*ids):
+    return [{"id": id_, "title": id_} for id_ in ids]
+
+def test_enqueue_dedups(postgres):
+    async def test(pool):
+        async with pool.connection() as conn:
+            await conn.execute("INSERT INTO posts (id, author) VALUES ('done', 'u1')")
+        queue = WorkQueue(pool)
+        assert await queue.enqueue(posts("p1", "p1", "p2", "done"), batch_size=2) == 2
+        assert await queue.enqueue(posts("p1", "p2")) == 0
+        assert [row[:2] for row in await rows(pool)] == [("p1", "pending"), ("p2", "pending")]
+    run_with_queue(postgres, test)
+
+def test_workers_claim_disjoint_rows(postgres):
+    async def test(pool):
+        await WorkQueue(pool).enqueue(posts(*[f"p{i:02}" for i in range(20)]))
+        a, b = WorkQueue(pool, "a", batch_size=8), WorkQueue(pool, "b", batch_size=8)
+        claimed = {"a": [], "b": []}
+        for _ in range(3):
+            batches = await asyncio.gather(a.claim(), b.claim())
+            claimed["a"] += [post["id"] for post in batches[0]]
+            claimed["b"] += [post["id"] for post in batches[1]]
+        assert not set(claimed["a"]) & set(claimed["b"])
+        assert sorted(claimed["a"] + claimed["b"]) == [f"p{i:02}" for i in range(20)]
+        assert a.held == set(claimed["a"]) and b.held == set(claimed["b"])
+        assert {(row[2], row[0]) for row in await rows(pool)} == {(worker, id_) for worker, ids in claimed.items() for id_ in ids}
+    run_with_queue(postgres, test)
+
+def test_expired_lease_is_reclaimed_and_old_worker_cannot_complete(postgres):
+    async def test(pool):
+        a, b = WorkQueue(pool, "a", lease=0), WorkQueue(pool, "b")
+        await a.enqueue(posts("p1"))
+        assert [post["id"] for post in await a.claim()] == ["p1"]
+        # a's lease ran out, so b takes the post over
+        assert [post["id"] for post in await b.claim()] == ["p1"]
+        assert await rows(pool) == [("p1", "leased", "b", 2)]
+        await a.complete(["p1"])
+        await a.fail("p1", "late failure")
+        assert await rows(pool) == [("p1", "leased", "b", 2)]
+        await b.complete(["p1"])
+        assert await rows(pool) == [("p1", "done", "b", 2)]
+        assert await b.outstanding() == 0
+    run_with_queue(postgres, test)
+
+def test_fail_retries_then_dead_letters(postgres):
+    async def test(pool):
+        queue = WorkQueue(pool, "a", max_attempts=2, backoff_base=0)
+        await queue.enqueue(posts("p1"))
+        await queue.claim()
+        await queue.fail("p1", "first")
+        assert await rows(pool) == [("p1", "pending", None, 1)]
+        assert [post["id"] for post in await queue.claim()] == ["p1"]
+        await queue.fail("p1", "second")
+        assert await rows(pool) == [("p1", "dead", None, 2)]
+        assert await queue.claim() == []
+        async with pool.connection() as conn:
+            cur = await conn.execute("SELECT last_error FROM post_queue")
+            assert (await cur.fetchone())[0] == "second"
+    run_with_queue(postgres, test)
+
+def test_backoff_delays_retry(postgres):
+    async def test(pool):
+        queue = WorkQueue(pool, "a", backoff_base=60)
+        await queue.enqueue(posts("p1"))
+        await queue.claim()
+        await queue.fail("p1", "throttled")
+        assert await queue.claim() == []
+        assert await queue.outstanding() == 1
+    run_with_queue(postgres, test)
+
+def test_heartbeat_extends_leases_and_reaps_expired_last_attempts(postgres):
+    async def test(pool):
+        a = WorkQueue(pool, "a", lease=0.3, max_attempts=1)
+        b = WorkQueue(pool, "b", lease=0, max_attempts=1)
+        await a.enqueue(posts("p1", "p2"))
+        await a.claim(limit=1)
+        await b.claim(limit=1)
+
+        async def lease_until(id_):
+            async with pool.connection() as conn:
+                cur = await conn.execute("SELECT lease_until FROM post_queue WHERE id = %s", (id_,))
+                return (await cur.fetchone())[0]
+
+        before = await lease_until("p1")
+        beat = asyncio.create_task(a.heartbeat())
+        await asyncio.sleep(0.25)
+        beat.cancel()
+        assert await lease_until("p1") > before
+        # b's lease expired on its only attempt, nobody can claim it again, so it is dead-lettered
+        assert [row[:2] for row in await rows(pool)] == [("p1", "leased"), ("p2", "dead")]
+    run_with_queue(postgres, test)
+
+def test_posts_drains(postgres):
+    async def test(pool):
+        queue = WorkQueue(pool, "a", batch_size=2, poll_interval=0.01)
+        await queue.enqueue(posts("p1", "p2", "p3"))
+        seen = []
+        async for post in queue.posts(drain=True):
+            seen.append(post["id"])
+            await queue.complete([post["id"]])
+        assert sorted(seen) == ["p1", "p2", "p3"]
+        assert {row[1] for row in await rows(pool)} == {"done"}
+    run_with_queue(postgres, test)
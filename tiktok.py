@@ -1,14 +1,37 @@
 import asyncio
+from collections import deque
 import urllib.parse
-from utils import format_reply, format_comment, format_post, flatten_comments_and_replies, threaded_comments_and_replies
+from ratelimit import default_limiter
+from metrics import metrics
+from normalize import CommentNormalizer
+from utils import format_reply, format_comment, format_post, format_video_item, threaded_comments_and_replies
+
+class IncompleteListing(Exception):
+    # a strict listing stopped on a page without a comments object (an error or captcha body), items holds what was read before it
+    def __init__(self, message, items=()):
+        super().__init__(message)
+        self.items = list(items)
 
 class TikTok:
     TIKTOK_BASE_URL = "https://www.tiktok.com"
     TEMP_VIDEO_BASE_URL = "https://www.tikwm.com"
     UA = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:129.0) Gecko/20100101 Firefox/129.0"
 
-    def __init__(self, session):
+    def __init__(self, session, limiter=default_limiter, cache=None):
         self.session = session
+        self.limiter = limiter
+        self.cache = cache
+
+    async def __get_json(self, url, params=None, headers=None):
+        async def fetch():
+            endpoint = urllib.parse.urlparse(url).path
+            metrics.inc("tiktok_requests_total", endpoint=endpoint)
+            with metrics.timer("tiktok_request_seconds", endpoint=endpoint):
+                async with self.limiter.get(self.session, url, params=params, headers=headers) as response:
+                    return await response.json()
+        if self.cache is None:
+            return await fetch()
+        return await self.cache.get_json(fetch, url, params)
 
     async def __generate_x_bogus(self, url, UA):
         return url + UA
@@ -56,47 +79,46 @@ class TikTok:
 
         query_string = urllib.parse.urlencode(params)
 
-        params["X-Bogus"] = self.__generate_x_bogus(f"{self.TIKTOK_BASE_URL}/api/post/item_list/?{query_string}", self.UA)
+        params["X-Bogus"] = await self.__generate_x_bogus(f"{self.TIKTOK_BASE_URL}/api/post/item_list/?{query_string}", self.UA)
 
-        async with self.session.get(url, params=params) as response:
-                response.raise_for_status()
-                return await response.json()
+        return await self.__get_json(url, params=params)
 
-    async def __get_all_video_list_recursive(self):
-        video_list = self.__get_video_list()
-        if video_list["hasMore"]:
-            return
-        else:
-            self.__get_all_video_list_recursive(28, video_list["cursor"])
+    async def iter_video_pages(self, sec_uid, cursor=0, count=35):
+        # yields (posts, next cursor) per page; the next page is already being fetched while the caller works on this one
+        task = asyncio.create_task(self.__get_video_list(sec_uid, count, cursor))
+        try:
+            while task:
+                page = await task
+                task = None
+                next_cursor = page.get("cursor")
+                if page.get("hasMore") and next_cursor not in (None, cursor):
+                    task = asyncio.create_task(self.__get_video_list(sec_uid, count, next_cursor))
+                metrics.inc("video_pages_total")
+                yield [format_video_item(item) for item in page.get("itemList") or []], next_cursor if task else None
+                cursor = next_cursor
+        finally:
+            if task:
+                task.cancel()
 
     async def get_video_list(self, sec_uid):
-        all_video_list = []
-
-        async def fetch_recursive():
-            video_list = self.__get_video_list()
-            all_video_list.append(video_list["itemList"])
-            if video_list["hasMore"]:
-                return
-            else:
-                self.__get_all_video_list_recursive(28, video_list["cursor"])
-
-        await fetch_recursive()
-
-        return all_video_list
+        return [post async for posts, _ in self.iter_video_pages(sec_uid) for post in posts]
 
     async def get_video(self, post_id):
         url = f"{self.TEMP_VIDEO_BASE_URL}/video/media/wmplay/{post_id}.mp4"
-        async with self.session.get(url) as response:
-            response.raise_for_status()
+        async with self.limiter.get(self.session, url) as response:
             return await response.read()
 
+    async def stream_video(self, post_id, chunk_size=1024 * 1024):
+        url = f"{self.TEMP_VIDEO_BASE_URL}/video/media/wmplay/{post_id}.mp4"
+        async with self.limiter.get(self.session, url) as response:
+            async for chunk in response.content.iter_chunked(chunk_size):
+                yield chunk
+
     async def get_post(self, user_id, post_id):
         url = f"{self.TIKTOK_BASE_URL}/oembed"
         params = {"url": f"{self.TIKTOK_BASE_URL}/@{user_id}/video/{post_id}"}
-        async with self.session.get(url, params=params) as response:
-                response.raise_for_status()
-                body =  await response.json()
-                return format_post(body)
+        body = await self.__get_json(url, params=params)
+        return format_post(body)
 
     async def __get_comment(self, post_id, count, cursor):
         url = f"{self.TIKTOK_BASE_URL}/api/comment/list/"
@@ -112,63 +134,155 @@ class TikTok:
         }
         headers={"User-Agent": self.UA}
 
-        async with self.session.get(url, params=params, headers=headers) as response:
-            response.raise_for_status()
-            comment = await response.json()
-            return comment
+        comment = await self.__get_json(url, params=params, headers=headers)
+        return comment
 
-    async def __get_replies(self, post_id, comment_id, count):
+    async def __get_replies(self, post_id, comment_id, count, cursor=0):
         url = f"{self.TIKTOK_BASE_URL}/api/comment/list/reply"
         params = {
             "comment_id": comment_id,
             "count": count,
+            "cursor": cursor,
             "item_id": post_id
         }
-        async with self.session.get(url, params=params) as response:
-            response.raise_for_status()
-            return await response.json()
+        return await self.__get_json(url, params=params)
 
-    async def get_comments_replies(self, post_id, format):
-            comments = []
-            offset = 0
-            limit = 50
-
-            while True:
-                post = await self.__get_comment(post_id, limit, offset)
-                if not post or "comments" not in post:
-                    print("No comments object here")
-                    break
-                if post["comments"] == None:
-                    print("NO COMMENTS", post_id)
-                    break
-                comments.extend(post["comments"])
-                if post["has_more"] != 1:
-                    break
-                offset += limit
-
-            comments = [format_comment(comment) for comment in comments]
-
-            # below loop is the same as list comprehension above
-            # for comment in comments:
-            #     if comment["reply_count"] > 0:
-            #         replies = get_replies(post_id, comment["id"], comment["reply_count"])
-            #         replies = [process_reply(reply) for reply in replies["comments"]]
-            #         comment["replies"] = replies
-
-            tasks = []
-
-            for comment in comments:
-                if comment["reply_count"] > 0:
-                    task = asyncio.create_task(self.__get_replies(post_id, comment["id"], comment["reply_count"]))
-                    tasks.append((comment, task))
-
-            for comment, task in tasks:
-                replies = await task
-                comment["replies"] = [format_reply(reply) for reply in replies["comments"]]
-
-            if (format == "flat"):
-                return flatten_comments_and_replies(comments)
-            elif (format == "thread"):
-                return threaded_comments_and_replies(comments)
+    async def iter_comment_pages(self, post_id, limit=50, formatter=format_comment, strict=False):
+        # strict raises IncompleteListing where the listing would otherwise end early without saying so
+        offset = 0
+        while True:
+            post = await self.__get_comment(post_id, limit, offset)
+            if not post or "comments" not in post:
+                if strict:
+                    raise IncompleteListing(f"No comments object for {post_id} at {offset}")
+                print("No comments object here")
+                break
+            if post["comments"] == None:
+                print("NO COMMENTS", post_id)
+                break
+            metrics.inc("comment_pages_total")
+            metrics.inc("comments_parsed_total", len(post["comments"]))
+            if formatter is None:
+                yield post["comments"]
             else:
-                return comments
+                with metrics.timer("format_seconds", kind="comment"):
+                    comments = [formatter(comment) for comment in post["comments"]]
+                yield comments
+            if post["has_more"] != 1:
+                break
+            offset = post.get("cursor") or offset + limit
+
+    async def get_all_replies(self, post_id, comment_id, semaphore, limit=50, formatter=format_reply, strict=False):
+        replies = []
+        cursor = 0
+        while True:
+            async with semaphore:
+                page = await self.__get_replies(post_id, comment_id, limit, cursor)
+            if strict and (not page or "comments" not in page):
+                raise IncompleteListing(f"No comments object for replies to {comment_id} at {cursor}", replies)
+            if not page or not page.get("comments"):
+                break
+            metrics.inc("reply_pages_total")
+            metrics.inc("replies_parsed_total", len(page["comments"]))
+            if formatter is None:
+                replies.extend(page["comments"])
+            else:
+                with metrics.timer("format_seconds", kind="reply"):
+                    replies.extend(formatter(reply) for reply in page["comments"])
+            if page.get("has_more") != 1:
+                break
+            cursor = page.get("cursor") or cursor + limit
+        return replies
+
+    async def stream_comments_replies(self, post_id, format, reply_concurrency=8):
+        # reply fetches start as soon as their comment page arrives and run while later pages are fetched;
+        # items are yielded in comment order, "flat" yields each comment before its replies are known
+        semaphore = asyncio.Semaphore(reply_concurrency)
+        pending = deque()
+        seen = set()
+
+        def ready(item):
+            if format != "flat":
+                return True
+            if item["id"] in seen:
+                return False
+            seen.add(item["id"])
+            return True
+
+        def complete(comment, replies):
+            if format == "flat":
+                return [reply for reply in replies if ready(reply)]
+            comment["replies"] = replies
+            if format == "thread":
+                return threaded_comments_and_replies([comment])
+            return [comment]
+
+        try:
+            async for comments in self.iter_comment_pages(post_id):
+                for comment in comments:
+                    if format == "flat" and ready(comment):
+                        yield comment
+                    task = None
+                    if comment["reply_count"] > 0:
+                        task = asyncio.create_task(self.get_all_replies(post_id, comment["id"], semaphore))
+                    pending.append((comment, task))
+                while pending and (pending[0][1] is None or pending[0][1].done()):
+                    comment, task = pending.popleft()
+                    for item in complete(comment, task.result() if task else []):
+                        yield item
+            while pending:
+                comment, task = pending.popleft()
+                for item in complete(comment, await task if task else []):
+                    yield item
+        finally:
+            for _, task in pending:
+                if task:
+                    task.cancel()
+
+    async def get_normalized_comments(self, post_id, reply_concurrency=8, known_replies=None):
+        # raw pages go straight into the normalizer, reply fetches start as soon as their comment page arrives;
+        # known_replies maps comment id -> stored reply count, threads whose count is unchanged are not refetched;
+        # a listing cut short keeps what was read and leaves normalizer.complete false
+        semaphore = asyncio.Semaphore(reply_concurrency)
+        normalizer = CommentNormalizer(post_id)
+        complete = True
+        tasks = []
+        try:
+            try:
+                async for comments in self.iter_comment_pages(post_id, formatter=None, strict=True):
+                    with metrics.timer("normalize_seconds", kind="comment"):
+                        for comment in comments:
+                            normalizer.add_comment(comment)
+                    for comment in comments:
+                        total = comment["reply_comment_total"]
+                        if known_replies is not None:
+                            if known_replies.get(comment["cid"], 0) == total:
+                                if total:
+                                    metrics.inc("reply_threads_skipped_total")
+                                continue
+                            normalizer.threads.add(comment["cid"])
+                        if total > 0:
+                            tasks.append(asyncio.create_task(self.get_all_replies(post_id, comment["cid"], semaphore, formatter=None, strict=True)))
+            except IncompleteListing as e:
+                metrics.inc("listings_incomplete_total", kind="comment")
+                print("Incomplete listing", e)
+                complete = False
+            for task in tasks:
+                try:
+                    replies = await task
+                except IncompleteListing as e:
+                    metrics.inc("listings_incomplete_total", kind="reply")
+                    print("Incomplete listing", e)
+                    complete = False
+                    replies = e.items
+                with metrics.timer("normalize_seconds", kind="reply"):
+                    for reply in replies:
+                        normalizer.add_reply(reply)
+        finally:
+            for task in tasks:
+                task.cancel()
+        normalizer.complete = complete
+        return normalizer
+
+    async def get_comments_replies(self, post_id, format):
+        return [item async for item in self.stream_comments_replies(post_id, format)]
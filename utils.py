@@ -1,7 +1,9 @@
 import re
+import json
 import mimetypes
 import urllib.parse
 from collections import defaultdict, deque
+from ratelimit import default_limiter
 
 def topological_sort(items):
     graph = defaultdict(list)
@@ -38,9 +40,67 @@ def get_list(filename):
         list = file.read()
         return list.split()
 
-async def fetch_resource(session, url):
-    async with session.get(url) as response:
-        response.raise_for_status()
+def iter_json_items(filename, chunk_size=1 << 16):
+    # yields the items of a top-level JSON array, or of a JSON Lines file, without loading the whole file;
+    # a malformed array (missing or doubled commas, no closing bracket) raises json.JSONDecodeError
+    decoder = json.JSONDecoder()
+    with open(filename, "r") as file:
+        buffer = file.read(chunk_size)
+        position = 0
+        # decided by the first non-whitespace character, None until it has been read
+        array = None
+        # in an array, whether the next token is a value ("[" or "," read last) or a separator (a value read last)
+        value_next = True
+        first = True
+        read_size = chunk_size
+        eof = not buffer
+        while True:
+            while position < len(buffer) and buffer[position].isspace():
+                position += 1
+            if array is None and position < len(buffer):
+                array = buffer[position] == "["
+                if array:
+                    position += 1
+                continue
+            if position >= len(buffer):
+                if eof:
+                    if array:
+                        raise json.JSONDecodeError("Unterminated array", buffer, position)
+                    return
+            elif array and not value_next:
+                if buffer[position] == "]":
+                    return
+                if buffer[position] != ",":
+                    raise json.JSONDecodeError("Expecting ',' delimiter", buffer, position)
+                position += 1
+                value_next = True
+                continue
+            elif array and buffer[position] in ",]":
+                if buffer[position] == "]" and first:
+                    return
+                raise json.JSONDecodeError("Expecting value", buffer, position)
+            else:
+                try:
+                    item, end = decoder.raw_decode(buffer, position)
+                    # a value ending exactly at the buffer end may be truncated (e.g. a number), so wait for more input
+                    if end < len(buffer) or eof:
+                        yield item
+                        position = end
+                        value_next = False
+                        first = False
+                        read_size = chunk_size
+                        continue
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+            chunk = file.read(read_size)
+            eof = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+            read_size *= 2
+
+async def fetch_resource(session, url, limiter=default_limiter):
+    async with limiter.get(session, url) as response:
         return await response.read()
 
 def format_post(post):
@@ -65,6 +125,26 @@ def format_video_item_to_post(post):
         "thumbnail": post["thumbnail_url"]
     }
 
+def format_video_item(item):
+    # an itemList entry from /api/post/item_list/, in the shape of the video_items.json posts
+    video = item.get("video") or {}
+    stats = item.get("stats") or {}
+    return {
+        "id": item["id"],
+        "title": item.get("desc") or "",
+        "author": {"id": item["author"]["id"], "username": item["author"].get("uniqueId"), "nickname": item["author"].get("nickname")},
+        "width": video.get("width"),
+        "height": video.get("height"),
+        "format": video.get("format"),
+        "duration": video.get("duration"),
+        "likes_count": stats.get("diggCount"),
+        "plays_count": stats.get("playCount"),
+        "reposts_count": stats.get("repostCount", 0),
+        "shares_count": stats.get("shareCount"),
+        "created": item.get("createTime"),
+        "thumbnail": video.get("cover")
+    }
+
 def format_user(user):
     return {
         "id": user["uid"],
@@ -97,12 +177,43 @@ def format_reply(reply):
         "parent": reply["reply_id"]
     }
 
-    if "reply_to_userid" in reply and "reply_to_reply_id" in reply:
+    # reply_to_reply_id is "0" for a direct reply to the top-level comment
+    if "reply_to_userid" in reply and reply.get("reply_to_reply_id", "0") != "0":
         processed_reply["parent_user"] = reply["reply_to_userid"]
         processed_reply["parent"] = reply["reply_to_reply_id"]
 
     return processed_reply
 
+def reply_children(comment):
+    # id -> direct children, in original order; replies whose parent is missing, or that sit on a cycle,
+    # hang off the top-level comment so every reply is reachable exactly once
+    replies = []
+    ids = set()
+    for reply in comment.get("replies", []):
+        if reply["id"] not in ids:
+            ids.add(reply["id"])
+            replies.append(reply)
+    parents = {}
+    for reply in replies:
+        parent = reply.get("parent")
+        parents[reply["id"]] = parent if parent in ids and parent != reply["id"] else comment["id"]
+
+    reachable = set()
+    children = defaultdict(list)
+    for reply in replies:
+        children[parents[reply["id"]]].append(reply["id"])
+    stack = [comment["id"]]
+    while stack:
+        for child in children.get(stack.pop(), ()):
+            reachable.add(child)
+            stack.append(child)
+
+    result = defaultdict(list)
+    for reply in replies:
+        parent = parents[reply["id"]] if reply["id"] in reachable else comment["id"]
+        result[parent].append(reply)
+    return result
+
 def threaded_comments_and_replies(comments):
     # comment
     #   reply A
@@ -117,21 +228,28 @@ def threaded_comments_and_replies(comments):
     #       reply B to A
     #           reply C to B
     #               reply F to C
-    #        reply D to A
     #           reply E to B
+    #       reply D to A
     for comment in comments:
         if "replies" in comment:
-            for reply in comment["replies"]:
-                if "parent_comment" in reply:
-                    # Make this a dict for more efficient lookups
-                    parent = next((p for p in comment["replies"] if p.get("id") == reply["parent_comment"]), None)
-                    if parent:
-                        if "replies" not in parent:
-                            parent["replies"] = []
-                        parent["replies"].append(reply)
-                        comment["replies"].remove(reply)
+            children = reply_children(comment)
+            for replies in children.values():
+                for reply in replies:
+                    if reply["id"] in children:
+                        reply["replies"] = children[reply["id"]]
+            comment["replies"] = children.get(comment["id"], [])
     return comments
 
+def iter_thread(comment):
+    # depth-first (depth, item) pairs without nesting anything, so huge threads can be rendered or exported as they are walked
+    children = reply_children(comment)
+    stack = [(0, comment)]
+    while stack:
+        depth, item = stack.pop()
+        yield depth, item
+        for child in reversed(children.get(item["id"], ())):
+            stack.append((depth + 1, child))
+
 def flatten_comments_and_replies(comments):
     # comment A
     #   reply A
@@ -0,0 +1,195 @@
+import os
+import json
+import socket
+import asyncio
+from metrics import metrics
+
+QUEUE_SCHEMA = [
+    """
+        CREATE TABLE IF NOT EXISTS post_queue (
+            id TEXT NOT NULL PRIMARY KEY,
+            post JSONB NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INT NOT NULL DEFAULT 0,
+            worker TEXT,
+            lease_until TIMESTAMP,
+            available_at TIMESTAMP NOT NULL DEFAULT now(),
+            last_error TEXT,
+            enqueued TIMESTAMP NOT NULL DEFAULT now(),
+            finished TIMESTAMP
+        )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_post_queue_pending ON post_queue (available_at) WHERE status = 'pending'",
+    "CREATE INDEX IF NOT EXISTS idx_post_queue_leased ON post_queue (lease_until) WHERE status = 'leased'",
+]
+
+STAGING_QUEUE = "CREATE TEMP TABLE IF NOT EXISTS staging_queue (id TEXT, post TEXT) ON COMMIT DELETE ROWS"
+
+# posts already in the posts table are done and are not queued again
+ENQUEUE = """
+    INSERT INTO post_queue (id, post)
+    SELECT DISTINCT ON (s.id) s.id, s.post::jsonb FROM staging_queue s
+    WHERE NOT EXISTS (SELECT 1 FROM posts p WHERE p.id = s.id)
+    ON CONFLICT (id) DO NOTHING
+"""
+
+# rows locked by another worker's claim are skipped instead of waited on, so workers never hand out the same post;
+# a lease that ran out means its worker died, and the post is claimed again like a pending one
+CLAIM = """
+    WITH claimed AS (
+        SELECT id FROM post_queue
+        WHERE ((status = 'pending' AND available_at <= now()) OR (status = 'leased' AND lease_until < now()))
+            AND attempts < %(max_attempts)s
+        ORDER BY available_at
+        LIMIT %(limit)s
+        FOR UPDATE SKIP LOCKED
+    )
+    UPDATE post_queue q SET status = 'leased', worker = %(worker)s, lease_until = now() + make_interval(secs => %(lease)s), attempts = q.attempts + 1
+    FROM claimed WHERE q.id = claimed.id
+    RETURNING q.id, q.post
+"""
+
+HEARTBEAT = """
+    UPDATE post_queue SET lease_until = now() + make_interval(secs => %(lease)s)
+    WHERE id = ANY(%(ids)s) AND worker = %(worker)s AND status = 'leased'
+"""
+
+COMPLETE = """
+    UPDATE post_queue SET status = 'done', finished = now(), lease_until = NULL, last_error = NULL
+    WHERE id = ANY(%(ids)s) AND worker = %(worker)s AND status = 'leased'
+"""
+
+# retries back off exponentially, a post that has used up its attempts is parked as dead with its last error
+FAIL = """
+    UPDATE post_queue SET
+        status = CASE WHEN attempts >= %(max_attempts)s THEN 'dead' ELSE 'pending' END,
+        available_at = now() + make_interval(secs => least(%(backoff_cap)s, %(backoff_base)s * 2 ^ attempts)),
+        worker = NULL, lease_until = NULL, last_error = %(error)s
+    WHERE id = %(id)s AND worker = %(worker)s AND status = 'leased'
+    RETURNING status
+"""
+
+# leases that expired on their last attempt are never claimed again, they are dead-lettered here
+REAP = """
+    UPDATE post_queue SET status = 'dead', worker = NULL, lease_until = NULL, last_error = coalesce(last_error, 'lease expired')
+    WHERE status = 'leased' AND lease_until < now() AND attempts >= %(max_attempts)s
+"""
+
+OUTSTANDING = "SELECT count(*) FROM post_queue WHERE status = 'pending' OR status = 'leased'"
+
+class WorkQueue:
+    def __init__(self, pool, worker=None, lease=300, max_attempts=5, batch_size=16, poll_interval=5.0, backoff_base=30, backoff_cap=3600):
+        self.pool = pool
+        self.worker = worker or f"{socket.gethostname()}-{os.getpid()}"
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        # ids claimed by this worker that are not finished yet, their leases are kept alive by heartbeat()
+        self.held = set()
+
+    async def create(self):
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cur:
+                for query in QUEUE_SCHEMA:
+                    await cur.execute(query)
+
+    async def enqueue(self, posts, batch_size=1000, on_enqueued=None):
+        # posts may be a plain or an async iterable, they are copied in batch_size at a time;
+        # on_enqueued is called with each post id once its batch has committed
+        queued = 0
+        batch = []
+
+        async def flush(batch):
+            async with self.pool.connection() as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute(STAGING_QUEUE)
+                    async with cur.copy("COPY staging_queue (id, post) FROM STDIN") as copy:
+                        for post in batch:
+                            await copy.write_row((post['id'], json.dumps(post)))
+                    await cur.execute(ENQUEUE)
+                    queued = cur.rowcount
+            if on_enqueued:
+                for post in batch:
+                    on_enqueued(post['id'])
+            return queued
+
+        if hasattr(posts, "__aiter__"):
+            async for post in posts:
+                batch.append(post)
+                if len(batch) >= batch_size:
+                    queued += await flush(batch)
+                    batch = []
+        else:
+            for post in posts:
+                batch.append(post)
+                if len(batch) >= batch_size:
+                    queued += await flush(batch)
+                    batch = []
+        if batch:
+            queued += await flush(batch)
+        metrics.inc("queue_enqueued_total", queued)
+        return queued
+
+    async def claim(self, limit=None):
+        async with self.pool.connection() as conn:
+            cur = await conn.execute(CLAIM, {"limit": limit or self.batch_size, "worker": self.worker, "lease": self.lease, "max_attempts": self.max_attempts})
+            rows = await cur.fetchall()
+        self.held.update(id_ for id_, _ in rows)
+        metrics.inc("queue_claimed_total", len(rows))
+        return [post for _, post in rows]
+
+    async def outstanding(self):
+        async with self.pool.connection() as conn:
+            cur = await conn.execute(OUTSTANDING)
+            return (await cur.fetchone())[0]
+
+    async def complete(self, ids):
+        ids = list(ids)
+        if not ids:
+            return
+        async with self.pool.connection() as conn:
+            await conn.execute(COMPLETE, {"ids": ids, "worker": self.worker})
+        self.held.difference_update(ids)
+        metrics.inc("queue_completed_total", len(ids))
+
+    async def fail(self, id_, error):
+        async with self.pool.connection() as conn:
+            cur = await conn.execute(FAIL, {"id": id_, "worker": self.worker, "error": str(error), "max_attempts": self.max_attempts, "backoff_base": self.backoff_base, "backoff_cap": self.backoff_cap})
+            row = await cur.fetchone()
+        self.held.discard(id_)
+        if row and row[0] == "dead":
+            metrics.inc("queue_dead_total")
+            print("Dead-lettered", id_, error)
+
+    async def heartbeat(self):
+        # extends every held lease well before it runs out, and dead-letters posts whose last lease expired
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                async with self.pool.connection() as conn:
+                    if self.held:
+                        await conn.execute(HEARTBEAT, {"ids": list(self.held), "worker": self.worker, "lease": self.lease})
+                    cur = await conn.execute(REAP, {"max_attempts": self.max_attempts})
+                    metrics.inc("queue_dead_total", cur.rowcount)
+            except Exception as e:
+                print("Heartbeat failed", e)
+
+    async def posts(self, drain=True):
+        # claims a batch whenever the previous one has been taken, so leases are only held for posts about to be worked on;
+        # with drain the stream ends once nothing is pending or leased, otherwise it keeps polling for new work
+        beat = asyncio.create_task(self.heartbeat())
+        try:
+            while True:
+                posts = await self.claim()
+                for post in posts:
+                    yield post
+                if posts:
+                    continue
+                if drain and not await self.outstanding():
+                    break
+                await asyncio.sleep(self.poll_interval)
+        finally:
+            beat.cancel()